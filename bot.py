@@ -1,73 +1,171 @@
 ﻿import asyncio
 import logging
+import os
+import signal
 from datetime import datetime
 from aiogram import Bot, Dispatcher
 from aiogram.enums import ParseMode
 from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.methods import TelegramMethod
+from aiohttp import web
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 
 from config import config
 from database import db
 from handlers import admin, requests, schedule
+from services import engine, welcome_queue, ingest_buffer, job_manager
+from supervisor import run_supervisor, until_signal
+from utils import RateLimitMiddleware, TokenBucket, owns_channel, webhook_secret_ok
 
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+LOG_PREFIX = f"[w{config.WORKER_INDEX}] " if config.WORKER_INDEX >= 0 else ""
+logging.basicConfig(level=logging.INFO, format=f'%(asctime)s - {LOG_PREFIX}%(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
 scheduler = AsyncIOScheduler(timezone="Europe/Moscow")
 
 
-async def scheduled_accept(bot: Bot):
-    """Автоматический приём по расписанию"""
-    now = datetime.now()
-    current_day = now.weekday()
-    current_time = now.strftime("%H:%M")
+# Задачи приёма по расписанию; занятые каналы общие с заданиями — job_manager.busy_channels
+schedule_tasks: set[asyncio.Task] = set()
+schedule_slots = asyncio.Semaphore(config.SCHEDULE_CONCURRENCY)
 
-    channels = await db.get_channels_with_schedule()
 
-    for channel in channels:
-        sched = channel.get('schedule', {})
+async def run_scheduled_channel(bot: Bot, channel: dict):
+    channel_id = channel['channel_id']
+    try:
+        async with schedule_slots:
+            count = (channel.get('schedule') or {}).get('count', 'all')
+
+            # Заявки читаются страницами по ходу приёма, а не списком целиком
+            limit = None if count == 'all' else count
+            pending = db.iter_pending(channel_id, limit, config.JOB_BATCH_SIZE)
+
+            result = await engine.approve(
+                bot, channel_id, pending, 0, channel.get('welcome_message'),
+                concurrency=config.SCHEDULE_CHANNEL_CONCURRENCY
+            )
+
+            if result.accepted > 0:
+                logger.info(f"Расписание: принято {result.accepted} в {channel['title']}")
+    except Exception:
+        logger.exception(f"Расписание: ошибка в {channel['title']}")
+    finally:
+        job_manager.release_channel(channel_id)
 
-        if not sched.get('enabled'):
-            continue
 
-        days = sched.get('days', [])
-        time = sched.get('time', '12:00')
-        count = sched.get('count', 'all')
+async def scheduled_accept(bot: Bot):
+    """Автоматический приём по расписанию"""
+    now = datetime.now()
 
-        # Проверяем день и время
-        if current_day not in days:
+    # Только каналы, чей слот наступил; пропущенные из-за простоя догоняются здесь же
+    for channel in await db.get_due_channels(now):
+        # Слот чужого канала заберёт его воркер
+        if not owns_channel(channel['channel_id']):
             continue
-
-        if current_time != time:
+        # Прошлый запуск или задание ещё идут: слот останется due и будет взят, когда они закончатся
+        if not job_manager.claim_channel(channel['channel_id']):
+            continue
+        claimed = False
+        try:
+            claimed = await db.claim_schedule_run(channel, now)
+        finally:
+            if not claimed:
+                job_manager.release_channel(channel['channel_id'])
+        if not claimed:
             continue
 
-        # Получаем заявки
-        pending = await db.get_pending_requests(channel['channel_id'])
+        # Каналы обрабатываются параллельно, тик не ждёт их завершения
+        task = asyncio.create_task(run_scheduled_channel(bot, channel))
+        schedule_tasks.add(task)
+        task.add_done_callback(schedule_tasks.discard)
+
+
+async def compact_rollups():
+    """Сворачивает старые часовые сводки в дневные"""
+    removed = await db.compact_rollups()
+    if removed:
+        logger.info(f"Сводки: свёрнуто часовых корзин {removed}")
+
+
+async def sync_channels():
+    """Воркер: дочитывает каналы, изменённые другими процессами; без супервизора останавливается"""
+    supervisor_pid = os.getppid()
+    while True:
+        await asyncio.sleep(config.CHANNEL_SYNC_INTERVAL)
+        if os.getppid() != supervisor_pid:
+            logger.warning("Супервизор завершился, останавливаюсь")
+            os.kill(os.getpid(), signal.SIGTERM)
+            return
+        try:
+            await db.sync_channels()
+        except Exception:
+            logger.exception("Не удалось обновить каналы")
+
+
+async def run_polling(bot: Bot, dp: Dispatcher):
+    await bot.delete_webhook(drop_pending_updates=True)
+    await dp.start_polling(bot)
+
+
+async def run_webhook(bot: Bot, dp: Dispatcher):
+    """Встроенный aiohttp-сервер: сразу отвечает 200, обновление обрабатывается фоновой задачей"""
+    # Свои задачи, чтобы при остановке дождаться уже принятых обновлений
+    tasks: set[asyncio.Task] = set()
+
+    async def feed(update: dict):
+        try:
+            result = await dp.feed_raw_update(bot, update)
+            if isinstance(result, TelegramMethod):
+                await dp.silent_call_request(bot, result)
+        except Exception:
+            logger.exception(f"Ошибка обработки обновления {update.get('update_id')}")
+
+    async def handle(request: web.Request) -> web.Response:
+        if not webhook_secret_ok(request.headers, config.WEBHOOK_SECRET):
+            return web.Response(status=401)
+        task = asyncio.create_task(feed(await request.json()))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+        return web.json_response({})
+
+    app = web.Application()
+    app.router.add_post(config.WEBHOOK_PATH, handle)
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, config.WEBHOOK_HOST, config.WEBHOOK_PORT).start()
+    logger.info(f"🌐 Вебхук слушает {config.WEBHOOK_HOST}:{config.WEBHOOK_PORT}{config.WEBHOOK_PATH}")
+
+    if config.WEBHOOK_URL:
+        await bot.set_webhook(
+            config.WEBHOOK_URL.rstrip("/") + config.WEBHOOK_PATH,
+            secret_token=config.WEBHOOK_SECRET or None,
+            allowed_updates=dp.resolve_used_update_types(),
+            drop_pending_updates=True
+        )
 
-        if not pending:
-            continue
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+        # Дорабатываем уже принятые обновления
+        await asyncio.gather(*tasks, return_exceptions=True)
 
-        to_accept = pending if count == 'all' else pending[:count]
 
-        success = 0
-        for req in to_accept:
-            try:
-                await bot.approve_chat_join_request(channel['channel_id'], req['user_id'])
-                await db.update_request(req['id'], 'accepted', 0)
-                await db.increment_accepted(channel['channel_id'])
-                success += 1
+def create_bot() -> Bot:
+    session = None
+    if config.BOT_API_URL:
+        session = AiohttpSession(api=TelegramAPIServer.from_base(config.BOT_API_URL))
+    return Bot(token=config.BOT_TOKEN, session=session, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
 
-                if channel.get('welcome_message'):
-                    try:
-                        await bot.send_message(req['user_id'], channel['welcome_message'], parse_mode="HTML")
-                    except:
-                        pass
-            except:
-                pass
 
-        if success > 0:
-            await db.update_stats(channel['channel_id'], accepted=success)
-            logger.info(f"Расписание: принято {success} в {channel['title']}")
+def create_dispatcher() -> Dispatcher:
+    dp = Dispatcher()
+    dp.include_router(admin.router)
+    dp.include_router(requests.router)
+    dp.include_router(schedule.router)
+    return dp
 
 
 async def main():
@@ -75,30 +173,58 @@ async def main():
         logger.error("❌ BOT_TOKEN не установлен")
         return
 
-    bot = Bot(token=config.BOT_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
-    dp = Dispatcher()
+    if config.WORKERS > 1 and config.WORKER_INDEX < 0:
+        await run_supervisor(create_bot(), create_dispatcher())
+        return
 
-    dp.include_router(admin.router)
-    dp.include_router(requests.router)
-    dp.include_router(schedule.router)
+    bot = create_bot()
+    # Лимиты Bot API общие на токен: воркеры делят их поровну
+    share = config.WORKERS if config.WORKER_INDEX >= 0 else 1
+    bot.session.middleware(RateLimitMiddleware(config.API_RATE / share))
+    welcome_queue.bucket = TokenBucket(config.WELCOME_RATE / share)
+    dp = create_dispatcher()
 
     await db.init()
     logger.info("✅ БД готова")
 
+    welcome_queue.start(bot)
+    if config.INGEST_BUFFER:
+        ingest_buffer.start()
+    await job_manager.start(bot)
+
     # Запускаем планировщик (проверка каждую минуту)
     scheduler.add_job(scheduled_accept, 'cron', minute='*', args=[bot])
+    if config.WORKER_INDEX <= 0:
+        scheduler.add_job(compact_rollups, 'cron', hour=4, minute=30)
     scheduler.start()
     logger.info("✅ Планировщик запущен")
 
+    # Каналы меняют и другие воркеры (админка живёт на нулевом)
+    sync_task = asyncio.create_task(sync_channels()) if config.WORKER_INDEX >= 0 else None
+
     try:
-        await bot.delete_webhook(drop_pending_updates=True)
         info = await bot.get_me()
-        logger.info(f"🚀 @{info.username} запущен")
-        await dp.start_polling(bot)
+        logger.info(f"🚀 @{info.username} запущен ({config.MODE})")
+        serve = run_webhook(bot, dp) if config.MODE == "webhook" else run_polling(bot, dp)
+        if config.WORKER_INDEX >= 0:
+            # Воркер останавливает супервизор; Ctrl+C из терминала обрабатывает только он
+            serve = until_signal(serve, signal.SIGTERM)
+        await serve
     finally:
+        if sync_task:
+            sync_task.cancel()
         scheduler.shutdown()
+        for task in list(schedule_tasks):
+            task.cancel()
+        await asyncio.gather(*schedule_tasks, return_exceptions=True)
+        await job_manager.stop()
+        await ingest_buffer.stop()
+        await welcome_queue.stop()
+        await db.close()
         await bot.session.close()
 
 
 if __name__ == "__main__":
+    if config.WORKER_INDEX >= 0:
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
     asyncio.run(main())
\ No newline at end of file
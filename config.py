@@ -11,7 +11,48 @@ class Config:
     ADMIN_IDS: list[int] = field(default_factory=lambda: [
         int(x) for x in os.getenv("ADMIN_IDS", "").split(",") if x
     ])
+    # polling или webhook
+    MODE: str = os.getenv("MODE", "polling")
+    # Публичный адрес вебхука; пустой — вебхук не регистрируется (локальная проверка)
+    WEBHOOK_URL: str = os.getenv("WEBHOOK_URL", "")
+    WEBHOOK_PATH: str = os.getenv("WEBHOOK_PATH", "/webhook")
+    WEBHOOK_SECRET: str = os.getenv("WEBHOOK_SECRET", "")
+    WEBHOOK_HOST: str = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+    WEBHOOK_PORT: int = int(os.getenv("WEBHOOK_PORT", "8080"))
+    # Свой Bot API сервер, например локальная заглушка из scripts/fake_telegram.py
+    BOT_API_URL: str = os.getenv("BOT_API_URL", "")
+    # Больше одного — bot.py запускает супервизор: N процессов, канал обслуживает воркер channel_id % N
+    WORKERS: int = int(os.getenv("WORKERS", "1"))
+    # Номер воркера задаёт супервизор; -1 — обычный процесс, которому принадлежат все каналы
+    WORKER_INDEX: int = int(os.getenv("WORKER_INDEX", "-1"))
+    # Воркеры слушают 127.0.0.1:WORKER_PORT + номер
+    WORKER_PORT: int = int(os.getenv("WORKER_PORT", "8100"))
+    CHANNEL_SYNC_INTERVAL: float = 1.0
     DATABASE_PATH: str = "bot_database.db"
+    DB_READERS: int = 4
+    APPROVE_CONCURRENCY: int = 10
+    APPROVE_FLUSH_SIZE: int = 100
+    API_RATE: float = 25.0
+    API_MAX_RETRIES: int = 3
+    WELCOME_WORKERS: int = 4
+    WELCOME_RATE: float = 10.0
+    WELCOME_QUEUE_SIZE: int = 100_000
+    SCHEDULE_CONCURRENCY: int = 4
+    SCHEDULE_CHANNEL_CONCURRENCY: int = 5
+    JOB_BATCH_SIZE: int = 200
+    JOB_PROGRESS_INTERVAL: float = 2.0
+    INGEST_BUFFER: bool = os.getenv("INGEST_BUFFER", "0") == "1"
+    INGEST_BATCH_SIZE: int = 500
+    INGEST_FLUSH_DELAY: float = 0.02
+    # Telegram принимает от бота файлы до 50 МБ; больше — режем на части
+    EXPORT_PART_SIZE: int = 48 * 1024 * 1024
+    EXPORT_SPOOL_SIZE: int = 1024 * 1024
+    DASHBOARD_TTL: float = 10.0
+    ROLLUP_HOURLY_DAYS: int = 14
+    INFO_CACHE_TTL: float = 60.0
+    INFO_CACHE_ITEMS: int = 1000
+    INFO_CACHE_BYTES: int = 4 * 1024 * 1024
+    PROBE_CONCURRENCY: int = 10
     DEFAULT_WELCOME_MESSAGE: str = "🎉 Добро пожаловать!"
 
 
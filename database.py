@@ -1,152 +1,512 @@
-﻿import aiosqlite
+﻿import asyncio
+import aiosqlite
+import copy
 import json
+import time
+from contextlib import asynccontextmanager
 from datetime import datetime
-from typing import Optional, List, Dict
+from typing import AsyncIterator, Optional, List, Dict
 from collections import Counter
 from config import config
+from utils.helpers import next_schedule_run
 
 
 class Database:
-    def __init__(self, db_path: str = config.DATABASE_PATH):
+    def __init__(self, db_path: str = config.DATABASE_PATH, readers: int = config.DB_READERS):
         self.db_path = db_path
+        self.readers = readers
+        self._writer: Optional[aiosqlite.Connection] = None
+        self._write_lock = asyncio.Lock()
+        self._pool: asyncio.Queue = asyncio.Queue()
+        self._connections: List[aiosqlite.Connection] = []
+        self._channels: Dict[int, Dict] = {}
+        # Наибольшая ревизия каналов, которую видел кэш
+        self._revision = 0
+        # Сводка для /stats: (когда посчитана, данные)
+        self._dashboard: Optional[tuple] = None
+
+    # === Соединения ===
+
+    async def _connect(self) -> aiosqlite.Connection:
+        conn = await aiosqlite.connect(self.db_path)
+        conn.row_factory = aiosqlite.Row
+        await conn.execute('PRAGMA busy_timeout = 5000')
+        self._connections.append(conn)
+        return conn
+
+    @asynccontextmanager
+    async def _read(self):
+        """Соединение из пула читателей"""
+        conn = await self._pool.get()
+        try:
+            yield conn
+        finally:
+            self._pool.put_nowait(conn)
+
+    @asynccontextmanager
+    async def _write(self):
+        """Соединение-писатель: одна транзакция за раз, commit по выходу из блока"""
+        async with self._write_lock:
+            try:
+                yield self._writer
+            except BaseException:
+                await self._writer.rollback()
+                raise
+            await self._writer.commit()
 
     async def init(self):
-        async with aiosqlite.connect(self.db_path) as db:
-            await db.execute('''
-                CREATE TABLE IF NOT EXISTS channels (
-                    channel_id INTEGER PRIMARY KEY,
-                    title TEXT,
-                    auto_accept BOOLEAN DEFAULT 1,
-                    accepted_count INTEGER DEFAULT 0,
-                    welcome_message TEXT,
-                    schedule TEXT,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    is_active BOOLEAN DEFAULT 1
-                )
-            ''')
+        self._writer = await self._connect()
+        # WAL: читатели не блокируют писателя и друг друга
+        await self._writer.execute('PRAGMA journal_mode = WAL')
+        await self._writer.execute('PRAGMA synchronous = NORMAL')
 
-            await db.execute('''
-                CREATE TABLE IF NOT EXISTS requests (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id INTEGER,
-                    username TEXT,
-                    full_name TEXT,
-                    channel_id INTEGER,
-                    status TEXT DEFAULT 'pending',
-                    processed_by INTEGER,
-                    processed_at TIMESTAMP,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            ''')
+        async with self._write() as db:
+            await self._migrate(db)
 
-            await db.execute('''
-                CREATE TABLE IF NOT EXISTS stats (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    channel_id INTEGER,
-                    date DATE,
-                    accepted INTEGER DEFAULT 0,
-                    UNIQUE(channel_id, date)
-                )
-            ''')
+        for _ in range(self.readers):
+            self._pool.put_nowait(await self._connect())
 
-            await db.commit()
-            await self._migrate(db)
+        await self._load_channels()
+
+    async def close(self):
+        if self._writer:
+            await self._writer.execute('PRAGMA optimize')
+        for conn in self._connections:
+            await conn.close()
+        self._connections.clear()
+        self._writer = None
+        self._pool = asyncio.Queue()
+
+    # === Миграции ===
 
     async def _migrate(self, db):
+        """Применяет миграции новее PRAGMA user_version, каждую в своей транзакции"""
+        async with db.execute('PRAGMA user_version') as c:
+            version = (await c.fetchone())[0]
+
+        for number, migration in enumerate(self._migrations(), start=1):
+            if number <= version:
+                continue
+            await db.execute('BEGIN')
+            await migration(db)
+            await db.execute(f'PRAGMA user_version = {number}')
+            await db.commit()
+
+    def _migrations(self) -> list:
+        # Порядок важен: номер миграции = позиция в списке
+        return [
+            self._migration_base_schema,
+            self._migration_request_indexes,
+            self._migration_unique_pending,
+            self._migration_schedule_next_run,
+            self._migration_jobs,
+            self._migration_job_controls,
+            self._migration_export_marks,
+            self._migration_request_hours,
+            self._migration_rollups,
+            self._migration_channel_photo,
+            self._migration_channel_rights,
+            self._migration_channel_revision,
+            self._migration_unique_active_job,
+        ]
+
+    async def _migration_base_schema(self, db):
+        await db.execute('''
+            CREATE TABLE IF NOT EXISTS channels (
+                channel_id INTEGER PRIMARY KEY,
+                title TEXT,
+                auto_accept BOOLEAN DEFAULT 1,
+                accepted_count INTEGER DEFAULT 0,
+                welcome_message TEXT,
+                schedule TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                is_active BOOLEAN DEFAULT 1
+            )
+        ''')
+
+        await db.execute('''
+            CREATE TABLE IF NOT EXISTS requests (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER,
+                username TEXT,
+                full_name TEXT,
+                channel_id INTEGER,
+                status TEXT DEFAULT 'pending',
+                processed_by INTEGER,
+                processed_at TIMESTAMP,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+
+        await db.execute('''
+            CREATE TABLE IF NOT EXISTS stats (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                channel_id INTEGER,
+                date DATE,
+                accepted INTEGER DEFAULT 0,
+                UNIQUE(channel_id, date)
+            )
+        ''')
+
+        # Старые базы создавались без колонки расписания
         async with db.execute("PRAGMA table_info(channels)") as cursor:
             columns = [row[1] for row in await cursor.fetchall()]
 
         if 'schedule' not in columns:
             await db.execute('ALTER TABLE channels ADD COLUMN schedule TEXT')
-            await db.commit()
+
+    async def _migration_request_indexes(self, db):
+        # Очередь ожидающих: iter_pending / get_pending_count
+        await db.execute('''
+            CREATE INDEX IF NOT EXISTS idx_requests_pending
+            ON requests(channel_id, created_at) WHERE status = 'pending'
+        ''')
+        # Проверка дубликата ожидающей заявки; _migration_unique_pending заменяет его уникальным uq_requests_user_pending
+        await db.execute('''
+            CREATE INDEX IF NOT EXISTS idx_requests_user_pending
+            ON requests(user_id, channel_id) WHERE status = 'pending'
+        ''')
+        # Все заявки канала по времени: экспорт и статистика
+        await db.execute('''
+            CREATE INDEX IF NOT EXISTS idx_requests_channel_created
+            ON requests(channel_id, created_at)
+        ''')
+        # Ключ у idx_requests_pending тот же, что у полного индекса, и даже со статистикой
+        # планировщик выбирает полный — запросы по очереди указывают индекс через INDEXED BY
+        await db.execute('PRAGMA analysis_limit = 1000')
+        await db.execute('ANALYZE requests')
+
+    async def _migration_unique_pending(self, db):
+        # Дубликаты, успевшие проскочить проверку, выводим из очереди
+        await db.execute('''
+            UPDATE requests SET status = 'duplicate'
+            WHERE status = 'pending' AND id NOT IN (
+                SELECT MIN(id) FROM requests WHERE status = 'pending' GROUP BY user_id, channel_id
+            )
+        ''')
+        await db.execute('DROP INDEX IF EXISTS idx_requests_user_pending')
+        await db.execute('''
+            CREATE UNIQUE INDEX IF NOT EXISTS uq_requests_user_pending
+            ON requests(user_id, channel_id) WHERE status = 'pending'
+        ''')
+
+    async def _migration_schedule_next_run(self, db):
+        await db.execute('ALTER TABLE channels ADD COLUMN next_run_at TIMESTAMP')
+        await db.execute('ALTER TABLE channels ADD COLUMN last_run_at TIMESTAMP')
+        await db.execute('''
+            CREATE INDEX IF NOT EXISTS idx_channels_next_run
+            ON channels(next_run_at) WHERE next_run_at IS NOT NULL
+        ''')
+
+        now = datetime.now()
+        async with db.execute("SELECT channel_id, schedule FROM channels WHERE schedule IS NOT NULL") as c:
+            rows = await c.fetchall()
+        for row in rows:
+            schedule = self._parse_channel(row)['schedule']
+            next_run = next_schedule_run(schedule, now) if isinstance(schedule, dict) else None
+            if next_run:
+                await db.execute('UPDATE channels SET next_run_at = ? WHERE channel_id = ?', (next_run, row[0]))
+
+    async def _migration_jobs(self, db):
+        await db.execute('''
+            CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                channel_id INTEGER NOT NULL,
+                status TEXT DEFAULT 'running',
+                target INTEGER,
+                processed INTEGER DEFAULT 0,
+                accepted INTEGER DEFAULT 0,
+                expired INTEGER DEFAULT 0,
+                failed INTEGER DEFAULT 0,
+                cursor_created_at TIMESTAMP DEFAULT '',
+                cursor_id INTEGER DEFAULT 0,
+                created_by INTEGER,
+                chat_id INTEGER,
+                message_id INTEGER,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                updated_at TIMESTAMP
+            )
+        ''')
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_jobs_active ON jobs(channel_id) WHERE status = 'running'")
+
+    async def _migration_job_controls(self, db):
+        # Темп приёма в заявках в секунду, NULL — без ограничения
+        await db.execute('ALTER TABLE jobs ADD COLUMN rate REAL')
+        await db.execute('DROP INDEX IF EXISTS idx_jobs_active')
+        await db.execute(
+            "CREATE INDEX IF NOT EXISTS idx_jobs_active ON jobs(channel_id) WHERE status IN ('running', 'paused')"
+        )
+
+    async def _migration_export_marks(self, db):
+        # Последняя выгруженная заявка для экспорта «с прошлого раза»
+        await db.execute('''
+            CREATE TABLE IF NOT EXISTS export_marks (
+                channel_id INTEGER,
+                admin_id INTEGER,
+                last_created_at TIMESTAMP,
+                last_id INTEGER,
+                exported_at TIMESTAMP,
+                PRIMARY KEY (channel_id, admin_id)
+            )
+        ''')
+
+    async def _migration_request_hours(self, db):
+        # Счётчики заявок по (день недели, час): экран пиковых часов читает 168 строк, а не всю requests.
+        # День недели как в Python: 0 — понедельник
+        await db.execute('''
+            CREATE TABLE IF NOT EXISTS request_hours (
+                channel_id INTEGER,
+                weekday INTEGER,
+                hour INTEGER,
+                count INTEGER DEFAULT 0,
+                PRIMARY KEY (channel_id, weekday, hour)
+            ) WITHOUT ROWID
+        ''')
+        # Триггер ловит любую вставку: одиночную, пачкой из буфера и при автоприёме
+        await db.execute('''
+            CREATE TRIGGER IF NOT EXISTS trg_requests_hours AFTER INSERT ON requests
+            WHEN NEW.created_at IS NOT NULL
+            BEGIN
+                INSERT INTO request_hours (channel_id, weekday, hour, count)
+                VALUES (
+                    NEW.channel_id,
+                    (CAST(strftime('%w', NEW.created_at) AS INTEGER) + 6) % 7,
+                    CAST(strftime('%H', NEW.created_at) AS INTEGER),
+                    1
+                )
+                ON CONFLICT(channel_id, weekday, hour) DO UPDATE SET count = count + 1;
+            END
+        ''')
+        await self._backfill_request_hours(db)
+
+    @staticmethod
+    async def _backfill_request_hours(db):
+        """Пересчитывает счётчики по часам из истории заявок"""
+        await db.execute('DELETE FROM request_hours')
+        await db.execute('''
+            INSERT INTO request_hours (channel_id, weekday, hour, count)
+            SELECT channel_id,
+                   (CAST(strftime('%w', created_at) AS INTEGER) + 6) % 7,
+                   CAST(strftime('%H', created_at) AS INTEGER),
+                   COUNT(*)
+            FROM requests
+            WHERE created_at IS NOT NULL
+            GROUP BY 1, 2, 3
+        ''')
+
+    async def _migration_rollups(self, db):
+        # Сводки по каналам: часовые корзины за последние дни и дневные навсегда.
+        # Время местное, как было у stats
+        for table, key in (('stats_hourly', 'bucket'), ('stats_daily', 'date')):
+            await db.execute(f'''
+                CREATE TABLE IF NOT EXISTS {table} (
+                    channel_id INTEGER,
+                    {key} TEXT,
+                    received INTEGER DEFAULT 0,
+                    accepted INTEGER DEFAULT 0,
+                    failed INTEGER DEFAULT 0,
+                    expired INTEGER DEFAULT 0,
+                    PRIMARY KEY (channel_id, {key})
+                ) WITHOUT ROWID
+            ''')
+
+        # Новая заявка (сразу принятая при автоприёме тоже) и её выход из очереди
+        await db.execute('''
+            CREATE TRIGGER IF NOT EXISTS trg_rollup_received AFTER INSERT ON requests
+            BEGIN
+                INSERT INTO stats_hourly (channel_id, bucket, received, accepted)
+                VALUES (NEW.channel_id, strftime('%Y-%m-%d %H:00', 'now', 'localtime'), 1, NEW.status = 'accepted')
+                ON CONFLICT(channel_id, bucket) DO UPDATE SET
+                    received = received + 1,
+                    accepted = accepted + excluded.accepted;
+            END
+        ''')
+        await db.execute('''
+            CREATE TRIGGER IF NOT EXISTS trg_rollup_processed AFTER UPDATE OF status ON requests
+            WHEN OLD.status = 'pending' AND NEW.status IN ('accepted', 'expired')
+            BEGIN
+                INSERT INTO stats_hourly (channel_id, bucket, accepted, expired)
+                VALUES (
+                    NEW.channel_id, strftime('%Y-%m-%d %H:00', 'now', 'localtime'),
+                    NEW.status = 'accepted', NEW.status = 'expired'
+                )
+                ON CONFLICT(channel_id, bucket) DO UPDATE SET
+                    accepted = accepted + excluded.accepted,
+                    expired = expired + excluded.expired;
+            END
+        ''')
+
+        # История: принятые из stats, поступившие и неактуальные из requests
+        await db.execute('''
+            INSERT INTO stats_daily (channel_id, date, received, accepted, expired)
+            SELECT channel_id, date, SUM(received), SUM(accepted), SUM(expired) FROM (
+                SELECT channel_id, date(date) AS date, 0 AS received, accepted, 0 AS expired FROM stats
+                UNION ALL
+                SELECT channel_id, date(created_at, 'localtime'), 1, 0, 0 FROM requests WHERE created_at IS NOT NULL
+                UNION ALL
+                SELECT channel_id, date(processed_at), 0, 0, 1 FROM requests
+                WHERE status = 'expired' AND processed_at IS NOT NULL
+            )
+            GROUP BY channel_id, date
+        ''')
+        await db.execute('DROP TABLE stats')
+
+    async def _migration_channel_photo(self, db):
+        # file_id загруженного аватара и big_file_unique_id, по которому видно смену аватара
+        await db.execute('ALTER TABLE channels ADD COLUMN photo_unique_id TEXT')
+        await db.execute('ALTER TABLE channels ADD COLUMN photo_file_id TEXT')
+
+    async def _migration_channel_rights(self, db):
+        # Может ли бот принимать заявки: NULL — ещё не проверяли, дальше обновляется из my_chat_member
+        await db.execute('ALTER TABLE channels ADD COLUMN can_invite BOOLEAN')
+        await db.execute('ALTER TABLE channels ADD COLUMN rights_checked_at TIMESTAMP')
+
+    async def _migration_channel_revision(self, db):
+        # Сквозной номер изменения канала: воркеры дочитывают в кэш всё, что новее их ревизии
+        await db.execute('ALTER TABLE channels ADD COLUMN revision INTEGER NOT NULL DEFAULT 0')
+        await db.execute('CREATE INDEX IF NOT EXISTS idx_channels_revision ON channels(revision)')
+
+    async def _migration_unique_active_job(self, db):
+        # Одно активное задание на канал: проверку в submit могли проскочить два быстрых запуска
+        await db.execute('''
+            UPDATE jobs SET status = 'cancelled'
+            WHERE status IN ('running', 'paused') AND id NOT IN (
+                SELECT MIN(id) FROM jobs WHERE status IN ('running', 'paused') GROUP BY channel_id
+            )
+        ''')
+        await db.execute('DROP INDEX IF EXISTS idx_jobs_active')
+        await db.execute(
+            "CREATE UNIQUE INDEX IF NOT EXISTS idx_jobs_active ON jobs(channel_id) WHERE status IN ('running', 'paused')"
+        )
 
     # === Каналы ===
+    # Настройки каналов меняются редко, а читаются на каждой заявке, поэтому
+    # все строки channels держим в памяти и обновляем при каждой записи;
+    # записи других процессов подтягивает sync_channels по ревизии
+
+    @staticmethod
+    def _parse_channel(row) -> Dict:
+        d = dict(row)
+        if d.get('schedule'):
+            try:
+                d['schedule'] = json.loads(d['schedule'])
+            except:
+                d['schedule'] = None
+        return d
+
+    async def _load_channels(self):
+        async with self._read() as db:
+            async with db.execute('SELECT * FROM channels') as c:
+                rows = await c.fetchall()
+        self._channels = {row['channel_id']: self._parse_channel(row) for row in rows}
+        self._revision = max((row['revision'] for row in rows), default=0)
+
+    async def _refresh_channel(self, db, channel_id: int):
+        # Писатели сериализованы блокировкой SQLite, поэтому ревизии растут в порядке коммитов
+        await db.execute(
+            'UPDATE channels SET revision = (SELECT MAX(revision) FROM channels) + 1 WHERE channel_id = ?',
+            (channel_id,)
+        )
+        async with db.execute('SELECT * FROM channels WHERE channel_id = ?', (channel_id,)) as c:
+            row = await c.fetchone()
+        if row:
+            self._channels[channel_id] = self._parse_channel(row)
+        else:
+            self._channels.pop(channel_id, None)
+
+    async def sync_channels(self) -> int:
+        """Подтягивает в кэш каналы, изменённые другими процессами; возвращает их число"""
+        async with self._read() as db:
+            async with db.execute(
+                    'SELECT * FROM channels WHERE revision > ? ORDER BY revision', (self._revision,)
+            ) as c:
+                rows = await c.fetchall()
+        for row in rows:
+            # Свою запись кэш мог получить раньше, чем этот снимок
+            cached = self._channels.get(row['channel_id'])
+            if cached is None or cached['revision'] < row['revision']:
+                self._channels[row['channel_id']] = self._parse_channel(row)
+            self._revision = row['revision']
+        return len(rows)
+
+    def _cached_channels(self, predicate=None) -> List[Dict]:
+        channels = [ch for ch in self._channels.values() if predicate is None or predicate(ch)]
+        channels.sort(key=lambda ch: ch['title'] or '')
+        return copy.deepcopy(channels)
 
     async def add_channel(self, channel_id: int, title: str) -> bool:
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._write() as db:
             await db.execute('''
                 INSERT INTO channels (channel_id, title, is_active)
                 VALUES (?, ?, 1)
                 ON CONFLICT(channel_id) DO UPDATE SET title = ?, is_active = 1
             ''', (channel_id, title, title))
-            await db.commit()
+            await self._refresh_channel(db, channel_id)
             return True
 
-    async def save_discovered_channel(self, channel_id: int, title: str):
-        async with aiosqlite.connect(self.db_path) as db:
+    async def save_discovered_channel(self, channel_id: int, title: str, can_invite: bool):
+        async with self._write() as db:
             await db.execute('''
-                INSERT INTO channels (channel_id, title, is_active)
-                VALUES (?, ?, 0)
-                ON CONFLICT(channel_id) DO UPDATE SET title = ?
-            ''', (channel_id, title, title))
-            await db.commit()
+                INSERT INTO channels (channel_id, title, is_active, can_invite, rights_checked_at)
+                VALUES (?, ?, 0, ?, ?)
+                ON CONFLICT(channel_id) DO UPDATE SET
+                    title = excluded.title,
+                    can_invite = excluded.can_invite,
+                    rights_checked_at = excluded.rights_checked_at
+            ''', (channel_id, title, can_invite, datetime.now()))
+            await self._refresh_channel(db, channel_id)
 
     async def mark_channel_removed(self, channel_id: int):
-        async with aiosqlite.connect(self.db_path) as db:
-            await db.execute('UPDATE channels SET is_active = 0 WHERE channel_id = ?', (channel_id,))
-            await db.commit()
+        async with self._write() as db:
+            await db.execute(
+                'UPDATE channels SET is_active = 0, can_invite = 0, rights_checked_at = ? WHERE channel_id = ?',
+                (datetime.now(), channel_id)
+            )
+            await self._refresh_channel(db, channel_id)
+
+    async def set_channel_rights(self, rights: Dict[int, bool]):
+        """Результаты проверки прав бота по нескольким каналам одной транзакцией"""
+        if not rights:
+            return
+
+        now = datetime.now()
+        async with self._write() as db:
+            await db.executemany(
+                'UPDATE channels SET can_invite = ?, rights_checked_at = ? WHERE channel_id = ?',
+                [(can_invite, now, channel_id) for channel_id, can_invite in rights.items()]
+            )
+            for channel_id in rights:
+                await self._refresh_channel(db, channel_id)
 
     async def get_channel(self, channel_id: int) -> Optional[Dict]:
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
-            async with db.execute('SELECT * FROM channels WHERE channel_id = ?', (channel_id,)) as c:
-                row = await c.fetchone()
-                if row:
-                    d = dict(row)
-                    if d.get('schedule'):
-                        try:
-                            d['schedule'] = json.loads(d['schedule'])
-                        except:
-                            d['schedule'] = None
-                    return d
+        channel = self._channels.get(channel_id)
+        if channel is None:
+            async with self._read() as db:
+                async with db.execute('SELECT * FROM channels WHERE channel_id = ?', (channel_id,)) as c:
+                    row = await c.fetchone()
+            if not row:
                 return None
+            channel = self._channels[channel_id] = self._parse_channel(row)
+        # Копия: обработчики правят schedule на месте до update_channel
+        return copy.deepcopy(channel)
 
     async def get_all_channels(self) -> List[Dict]:
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
-            async with db.execute('SELECT * FROM channels WHERE is_active = 1 ORDER BY title') as c:
-                rows = await c.fetchall()
-                result = []
-                for row in rows:
-                    d = dict(row)
-                    if d.get('schedule'):
-                        try:
-                            d['schedule'] = json.loads(d['schedule'])
-                        except:
-                            d['schedule'] = None
-                    result.append(d)
-                return result
+        return self._cached_channels(lambda ch: ch['is_active'])
 
     async def get_discovered_channels(self) -> List[Dict]:
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
-            async with db.execute('SELECT * FROM channels ORDER BY title') as c:
-                return [dict(row) for row in await c.fetchall()]
+        return self._cached_channels()
 
     async def get_channels_with_schedule(self) -> List[Dict]:
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
-            async with db.execute(
-                    "SELECT * FROM channels WHERE is_active = 1 AND schedule IS NOT NULL AND schedule != ''"
-            ) as c:
-                rows = await c.fetchall()
-                result = []
-                for row in rows:
-                    d = dict(row)
-                    if d.get('schedule'):
-                        try:
-                            d['schedule'] = json.loads(d['schedule'])
-                            if d['schedule'].get('enabled'):
-                                result.append(d)
-                        except:
-                            pass
-                return result
+        return self._cached_channels(
+            lambda ch: ch['is_active'] and isinstance(ch['schedule'], dict) and ch['schedule'].get('enabled')
+        )
 
     async def update_channel(self, channel_id: int, **kwargs) -> bool:
         if not kwargs:
             return False
 
         if 'schedule' in kwargs:
+            kwargs['next_run_at'] = next_schedule_run(kwargs['schedule'], datetime.now())
             if kwargs['schedule'] is not None:
                 kwargs['schedule'] = json.dumps(kwargs['schedule'], ensure_ascii=False)
             else:
@@ -155,139 +515,363 @@ class Database:
         set_clause = ', '.join(f'{k} = ?' for k in kwargs.keys())
         values = list(kwargs.values()) + [channel_id]
 
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._write() as db:
             await db.execute(f'UPDATE channels SET {set_clause} WHERE channel_id = ?', values)
-            await db.commit()
+            await self._refresh_channel(db, channel_id)
             return True
 
-    async def increment_accepted(self, channel_id: int) -> int:
-        async with aiosqlite.connect(self.db_path) as db:
-            await db.execute('UPDATE channels SET accepted_count = accepted_count + 1 WHERE channel_id = ?',
-                             (channel_id,))
-            await db.commit()
-            async with db.execute('SELECT accepted_count FROM channels WHERE channel_id = ?', (channel_id,)) as c:
-                row = await c.fetchone()
-                return row[0] if row else 0
-
-    # === Заявки ===
+    # === Расписание ===
 
-    async def has_pending_request(self, user_id: int, channel_id: int) -> bool:
-        async with aiosqlite.connect(self.db_path) as db:
+    async def get_due_channels(self, now: datetime) -> List[Dict]:
+        """Каналы, чей слот расписания уже наступил (включая пропущенные)"""
+        async with self._read() as db:
             async with db.execute(
-                    "SELECT 1 FROM requests WHERE user_id = ? AND channel_id = ? AND status = 'pending' LIMIT 1",
-                    (user_id, channel_id)
+                    'SELECT * FROM channels WHERE next_run_at <= ? AND is_active = 1 ORDER BY next_run_at',
+                    (now,)
             ) as c:
-                return await c.fetchone() is not None
+                return [self._parse_channel(row) for row in await c.fetchall()]
 
-    async def add_request(self, user_id: int, username: str, full_name: str, channel_id: int) -> Optional[int]:
-        if await self.has_pending_request(user_id, channel_id):
-            return None
+    async def claim_schedule_run(self, channel: Dict, now: datetime) -> bool:
+        """Забирает слот канала: переносит next_run_at на следующий и пишет last_run_at.
 
-        async with aiosqlite.connect(self.db_path) as db:
+        False — слот уже забрал другой запуск.
+        """
+        next_run = next_schedule_run(channel['schedule'], now)
+        async with self._write() as db:
             c = await db.execute(
-                'INSERT INTO requests (user_id, username, full_name, channel_id) VALUES (?, ?, ?, ?)',
-                (user_id, username, full_name, channel_id)
+                'UPDATE channels SET next_run_at = ?, last_run_at = ? WHERE channel_id = ? AND next_run_at = ?',
+                (next_run, now, channel['channel_id'], channel['next_run_at'])
             )
-            await db.commit()
-            return c.lastrowid
+            await self._refresh_channel(db, channel['channel_id'])
+            return c.rowcount == 1
 
-    async def update_request(self, request_id: int, status: str, processed_by: int) -> bool:
-        async with aiosqlite.connect(self.db_path) as db:
-            await db.execute(
+    # === Заявки ===
+
+    async def add_request(self, user_id: int, username: str, full_name: str, channel_id: int) -> int:
+        """Сохраняет заявку; если у пользователя уже есть ожидающая в этом канале — её id"""
+        async with self._write() as db:
+            async with db.execute('''
+                INSERT INTO requests (user_id, username, full_name, channel_id) VALUES (?, ?, ?, ?)
+                ON CONFLICT(user_id, channel_id) WHERE status = 'pending'
+                DO UPDATE SET username = excluded.username, full_name = excluded.full_name
+                RETURNING id
+            ''', (user_id, username, full_name, channel_id)) as c:
+                return (await c.fetchone())[0]
+
+    async def mark_requests_many(self, request_ids: List[int], status: str, processed_by: int):
+        now = datetime.now()
+        async with self._write() as db:
+            await db.executemany(
                 'UPDATE requests SET status = ?, processed_by = ?, processed_at = ? WHERE id = ?',
-                (status, processed_by, datetime.now(), request_id)
+                [(status, processed_by, now, request_id) for request_id in request_ids]
             )
-            await db.commit()
-            return True
 
-    async def get_pending_requests(self, channel_id: int) -> List[Dict]:
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
-            async with db.execute(
-                    "SELECT * FROM requests WHERE channel_id = ? AND status = 'pending' ORDER BY created_at",
-                    (channel_id,)
-            ) as c:
+    async def mark_accepted_many(self, channel_id: int, request_ids: List[int], processed_by: int) -> int:
+        """Статусы заявок и счётчик канала одной транзакцией; сводки ведёт триггер"""
+        if not request_ids:
+            return 0
+
+        now = datetime.now()
+        accepted = len(request_ids)
+
+        async with self._write() as db:
+            await db.executemany(
+                "UPDATE requests SET status = 'accepted', processed_by = ?, processed_at = ? WHERE id = ?",
+                [(processed_by, now, request_id) for request_id in request_ids]
+            )
+            await self._add_accepted(db, channel_id, accepted, now)
+        return accepted
+
+    async def add_requests_many(self, rows: List[tuple]):
+        """Пачка входящих заявок одной транзакцией.
+
+        Строка: (user_id, username, full_name, channel_id, status), где status —
+        исход автоприёма: 'pending', 'accepted', 'expired' или 'failed' (заявка остаётся в очереди).
+        """
+        now = datetime.now()
+        processed = [(row[4], now, row[0], row[3]) for row in rows if row[4] in ('accepted', 'expired')]
+
+        async with self._write() as db:
+            # Все заявки сначала ложатся ожидающими — повторная попадает на уже стоящую в очереди
+            await db.executemany('''
+                INSERT INTO requests (user_id, username, full_name, channel_id) VALUES (?, ?, ?, ?)
+                ON CONFLICT(user_id, channel_id) WHERE status = 'pending'
+                DO UPDATE SET username = excluded.username, full_name = excluded.full_name
+            ''', [row[:4] for row in rows])
+
+            if processed:
+                await db.executemany('''
+                    UPDATE requests SET status = ?, processed_by = 0, processed_at = ?
+                    WHERE user_id = ? AND channel_id = ? AND status = 'pending'
+                ''', processed)
+
+            for channel_id, count in Counter(row[3] for row in rows if row[4] == 'accepted').items():
+                await self._add_accepted(db, channel_id, count, now)
+            for channel_id, count in Counter(row[3] for row in rows if row[4] == 'failed').items():
+                await self._add_failed(db, channel_id, count)
+
+    async def _add_accepted(self, db, channel_id: int, accepted: int, now: datetime):
+        # Ревизия — чтобы счётчик увидели воркеры, которые держат этот канал в кэше
+        await db.execute('''
+            UPDATE channels SET accepted_count = accepted_count + ?,
+                                revision = (SELECT MAX(revision) FROM channels) + 1
+            WHERE channel_id = ?
+        ''', (accepted, channel_id))
+        if channel_id in self._channels:
+            self._channels[channel_id]['accepted_count'] += accepted
+
+    async def get_pending_page(self, channel_id: int, after: tuple = ('', 0), limit: int = 100) -> List[Dict]:
+        """Страница ожидающих заявок после ключа (created_at, id) — без OFFSET"""
+        async with self._read() as db:
+            async with db.execute('''
+                SELECT * FROM requests INDEXED BY idx_requests_pending
+                WHERE channel_id = ? AND status = 'pending' AND (created_at, id) > (?, ?)
+                ORDER BY created_at, id
+                LIMIT ?
+            ''', (channel_id, after[0], after[1], limit)) as c:
                 return [dict(row) for row in await c.fetchall()]
 
+    async def iter_pending(self, channel_id: int, limit: Optional[int] = None,
+                           batch_size: int = 500) -> AsyncIterator[Dict]:
+        """Ожидающие заявки по порядку, страницами по batch_size: в памяти не больше одной страницы"""
+        after = ('', 0)
+        while limit is None or limit > 0:
+            size = batch_size if limit is None else min(batch_size, limit)
+            page = await self.get_pending_page(channel_id, after, size)
+            for row in page:
+                yield row
+            if len(page) < size:
+                return
+            after = (page[-1]['created_at'], page[-1]['id'])
+            if limit is not None:
+                limit -= len(page)
+
     async def get_pending_count(self, channel_id: int) -> int:
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._read() as db:
             async with db.execute(
-                    "SELECT COUNT(*) FROM requests WHERE channel_id = ? AND status = 'pending'",
+                    "SELECT COUNT(*) FROM requests INDEXED BY idx_requests_pending "
+                    "WHERE channel_id = ? AND status = 'pending'",
                     (channel_id,)
             ) as c:
                 row = await c.fetchone()
                 return row[0] if row else 0
 
-    # === Статистика по часам ===
+    # === Фоновые задания ===
 
-    async def get_hourly_stats(self) -> Dict[int, int]:
-        """Возвращает статистику заявок по часам {час: количество}"""
-        async with aiosqlite.connect(self.db_path) as db:
+    async def create_job(self, channel_id: int, target: Optional[int], created_by: int,
+                         chat_id: int, message_id: int) -> Optional[Dict]:
+        """Новое задание; None, если в канале уже есть активное"""
+        async with self._write() as db:
             async with db.execute('''
-                SELECT strftime('%H', created_at) as hour, COUNT(*) as count
-                FROM requests
-                WHERE created_at IS NOT NULL
-                GROUP BY hour
-                ORDER BY hour
-            ''') as c:
-                rows = await c.fetchall()
-                return {int(row[0]): row[1] for row in rows if row[0]}
+                INSERT INTO jobs (channel_id, target, created_by, chat_id, message_id, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT(channel_id) WHERE status IN ('running', 'paused') DO NOTHING
+                RETURNING id
+            ''', (channel_id, target, created_by, chat_id, message_id, datetime.now())) as c:
+                row = await c.fetchone()
+        return await self.get_job(row[0]) if row else None
 
-    # === Статистика ===
+    async def get_job(self, job_id: int) -> Optional[Dict]:
+        async with self._read() as db:
+            async with db.execute('SELECT * FROM jobs WHERE id = ?', (job_id,)) as c:
+                row = await c.fetchone()
+                return dict(row) if row else None
 
-    async def update_stats(self, channel_id: int, accepted: int = 0):
-        today = datetime.now().date()
-        async with aiosqlite.connect(self.db_path) as db:
-            await db.execute('''
-                INSERT INTO stats (channel_id, date, accepted) VALUES (?, ?, ?)
-                ON CONFLICT(channel_id, date) DO UPDATE SET accepted = accepted + ?
-            ''', (channel_id, today, accepted, accepted))
-            await db.commit()
+    async def get_jobs(self, *statuses: str) -> List[Dict]:
+        placeholders = ', '.join('?' for _ in statuses)
+        async with self._read() as db:
+            async with db.execute(f'SELECT * FROM jobs WHERE status IN ({placeholders}) ORDER BY id', statuses) as c:
+                return [dict(row) for row in await c.fetchall()]
 
-    async def get_total_stats(self, channel_id: int) -> Dict:
-        async with aiosqlite.connect(self.db_path) as db:
+    async def get_active_job(self, channel_id: int) -> Optional[Dict]:
+        async with self._read() as db:
             async with db.execute(
-                    'SELECT COALESCE(SUM(accepted), 0) FROM stats WHERE channel_id = ?',
+                    "SELECT * FROM jobs WHERE channel_id = ? AND status IN ('running', 'paused') LIMIT 1",
                     (channel_id,)
             ) as c:
                 row = await c.fetchone()
-                return {'total_accepted': row[0]}
+                return dict(row) if row else None
+
+    async def advance_job(self, job_id: int, processed: int, accepted: int, expired: int, failed: int,
+                          cursor: tuple) -> Dict:
+        """Прибавляет счётчики пачки и сдвигает курсор задания"""
+        async with self._write() as db:
+            await db.execute('''
+                UPDATE jobs SET
+                    processed = processed + ?, accepted = accepted + ?, expired = expired + ?, failed = failed + ?,
+                    cursor_created_at = ?, cursor_id = ?, updated_at = ?
+                WHERE id = ?
+            ''', (processed, accepted, expired, failed, cursor[0], cursor[1], datetime.now(), job_id))
+        return await self.get_job(job_id)
+
+    async def set_job_status(self, job_id: int, status: str) -> Dict:
+        async with self._write() as db:
+            await db.execute('UPDATE jobs SET status = ?, updated_at = ? WHERE id = ?',
+                             (status, datetime.now(), job_id))
+        return await self.get_job(job_id)
+
+    async def set_job_rate(self, job_id: int, rate: Optional[float]) -> Dict:
+        async with self._write() as db:
+            await db.execute('UPDATE jobs SET rate = ?, updated_at = ? WHERE id = ?', (rate, datetime.now(), job_id))
+        return await self.get_job(job_id)
+
+    # === Статистика по часам ===
 
     async def get_hourly_stats(self, channel_id: int = None) -> Dict[int, int]:
-        """Статистика заявок по часам для конкретного канала или всех"""
-        async with aiosqlite.connect(self.db_path) as db:
+        """Заявки по часам {час: количество} для канала или всех"""
+        hours = Counter()
+        for (_, hour), count in (await self.get_weekly_hours(channel_id)).items():
+            hours[hour] += count
+        return dict(sorted(hours.items()))
+
+    async def get_weekly_hours(self, channel_id: int = None) -> Dict[tuple, int]:
+        """Заявки по дням недели и часам {(день, час): количество}; не больше 168 строк на канал"""
+        async with self._read() as db:
             if channel_id:
-                query = '''
-                    SELECT strftime('%H', created_at) as hour, COUNT(*) as count
-                    FROM requests
-                    WHERE channel_id = ? AND created_at IS NOT NULL
-                    GROUP BY hour
-                    ORDER BY hour
-                '''
+                query = 'SELECT weekday, hour, count FROM request_hours WHERE channel_id = ?'
                 params = (channel_id,)
             else:
-                query = '''
-                    SELECT strftime('%H', created_at) as hour, COUNT(*) as count
-                    FROM requests
-                    WHERE created_at IS NOT NULL
-                    GROUP BY hour
-                    ORDER BY hour
-                '''
+                query = 'SELECT weekday, hour, SUM(count) FROM request_hours GROUP BY weekday, hour'
                 params = ()
 
             async with db.execute(query, params) as c:
-                rows = await c.fetchall()
-                return {int(row[0]): row[1] for row in rows if row[0]}
+                return {(row[0], row[1]): row[2] for row in await c.fetchall() if row[2]}
 
-    async def get_all_requests(self, channel_id: int) -> List[Dict]:
-        """Получить все заявки канала (для экспорта)"""
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
+    # === Статистика ===
+
+    async def record_failed(self, channel_id: int, failed: int):
+        """Ошибки приёма: заявка осталась в очереди, поэтому триггер их не видит"""
+        async with self._write() as db:
+            await self._add_failed(db, channel_id, failed)
+
+    @staticmethod
+    async def _add_failed(db, channel_id: int, failed: int):
+        await db.execute('''
+            INSERT INTO stats_hourly (channel_id, bucket, failed)
+            VALUES (?, strftime('%Y-%m-%d %H:00', 'now', 'localtime'), ?)
+            ON CONFLICT(channel_id, bucket) DO UPDATE SET failed = failed + excluded.failed
+        ''', (channel_id, failed))
+
+    async def compact_rollups(self, keep_days: int = config.ROLLUP_HOURLY_DAYS) -> int:
+        """Сворачивает часовые корзины старше keep_days в дневные"""
+        async with self._write() as db:
+            cutoff = f"date('now', 'localtime', '-{int(keep_days)} days')"
+            await db.execute(f'''
+                INSERT INTO stats_daily (channel_id, date, received, accepted, failed, expired)
+                SELECT channel_id, substr(bucket, 1, 10), SUM(received), SUM(accepted), SUM(failed), SUM(expired)
+                FROM stats_hourly
+                WHERE bucket < {cutoff}
+                GROUP BY channel_id, substr(bucket, 1, 10)
+                ON CONFLICT(channel_id, date) DO UPDATE SET
+                    received = received + excluded.received,
+                    accepted = accepted + excluded.accepted,
+                    failed = failed + excluded.failed,
+                    expired = expired + excluded.expired
+            ''')
+            c = await db.execute(f'DELETE FROM stats_hourly WHERE bucket < {cutoff}')
+            return c.rowcount
+
+    async def get_daily_series(self, channel_id: int, days: int = 90) -> List[Dict]:
+        """Сводка канала по дням за последние days дней: дневные корзины плюс ещё не свёрнутые часовые"""
+        async with self._read() as db:
+            async with db.execute('''
+                SELECT date, SUM(received), SUM(accepted), SUM(failed), SUM(expired) FROM (
+                    SELECT date, received, accepted, failed, expired FROM stats_daily
+                    WHERE channel_id = ? AND date >= date('now', 'localtime', ?)
+                    UNION ALL
+                    SELECT substr(bucket, 1, 10), received, accepted, failed, expired FROM stats_hourly
+                    WHERE channel_id = ? AND bucket >= date('now', 'localtime', ?)
+                )
+                GROUP BY date
+                ORDER BY date
+            ''', (channel_id, f'-{days - 1} days', channel_id, f'-{days - 1} days')) as c:
+                return [
+                    {'date': row[0], 'received': row[1], 'accepted': row[2], 'failed': row[3], 'expired': row[4]}
+                    for row in await c.fetchall()
+                ]
+
+    async def get_dashboard_stats(self, ttl: float = config.DASHBOARD_TTL) -> Dict:
+        """Принято всего и сегодня, ожидают — по всем активным каналам одним запросом"""
+        if self._dashboard and time.monotonic() - self._dashboard[0] < ttl:
+            return copy.deepcopy(self._dashboard[1])
+
+        async with self._read() as db:
+            async with db.execute('''
+                SELECT channel_id, SUM(accepted), SUM(today), SUM(pending) FROM (
+                    SELECT channel_id, accepted, 0 AS today, 0 AS pending FROM stats_daily
+                    UNION ALL
+                    SELECT channel_id, accepted, CASE WHEN bucket >= date('now', 'localtime') THEN accepted ELSE 0 END, 0
+                    FROM stats_hourly
+                    UNION ALL
+                    SELECT channel_id, 0, 0, COUNT(*) FROM requests INDEXED BY idx_requests_pending
+                    WHERE status = 'pending' GROUP BY channel_id
+                )
+                GROUP BY channel_id
+            ''') as c:
+                totals = {row[0]: row[1:] for row in await c.fetchall()}
+
+        channels = []
+        for ch in self._cached_channels(lambda ch: ch['is_active']):
+            accepted, accepted_today, pending = totals.get(ch['channel_id'], (0, 0, 0))
+            ch.update(total_accepted=accepted, today_accepted=accepted_today, pending=pending)
+            channels.append(ch)
+
+        data = {
+            'channels': channels,
+            'total_accepted': sum(ch['total_accepted'] for ch in channels),
+            'today_accepted': sum(ch['today_accepted'] for ch in channels),
+            'total_pending': sum(ch['pending'] for ch in channels),
+        }
+        self._dashboard = (time.monotonic(), data)
+        return copy.deepcopy(data)
+
+    async def get_total_stats(self, channel_id: int) -> Dict:
+        async with self._read() as db:
+            async with db.execute('''
+                SELECT (SELECT COALESCE(SUM(accepted), 0) FROM stats_daily WHERE channel_id = ?)
+                     + (SELECT COALESCE(SUM(accepted), 0) FROM stats_hourly WHERE channel_id = ?)
+            ''', (channel_id, channel_id)) as c:
+                row = await c.fetchone()
+                return {'total_accepted': row[0]}
+
+    async def iter_requests(self, channel_id: int, after: tuple = ('', 0), until: Optional[str] = None,
+                            batch_size: int = 1000) -> AsyncIterator[Dict]:
+        """Заявки канала после ключа (created_at, id) и до until — диапазон по индексу (channel_id, created_at)"""
+        # Вместо открытой границы — дата позже любой; голое '9999' колонка TIMESTAMP сравнила бы как число
+        until = until or '9999-12-31'
+        while True:
+            async with self._read() as db:
+                async with db.execute('''
+                    SELECT * FROM requests
+                    WHERE channel_id = ? AND (created_at, id) > (?, ?) AND created_at < ?
+                    ORDER BY created_at, id
+                    LIMIT ?
+                ''', (channel_id, after[0], after[1], until, batch_size)) as c:
+                    page = [dict(row) for row in await c.fetchall()]
+            for row in page:
+                yield row
+            if len(page) < batch_size:
+                return
+            after = (page[-1]['created_at'], page[-1]['id'])
+
+    async def get_export_mark(self, channel_id: int, admin_id: int) -> Optional[Dict]:
+        async with self._read() as db:
             async with db.execute(
-                    "SELECT * FROM requests WHERE channel_id = ? ORDER BY created_at DESC",
-                    (channel_id,)
+                    'SELECT * FROM export_marks WHERE channel_id = ? AND admin_id = ?', (channel_id, admin_id)
             ) as c:
-                return [dict(row) for row in await c.fetchall()]
+                row = await c.fetchone()
+                return dict(row) if row else None
+
+    async def set_export_mark(self, channel_id: int, admin_id: int, last: tuple):
+        async with self._write() as db:
+            await db.execute('''
+                INSERT INTO export_marks (channel_id, admin_id, last_created_at, last_id, exported_at)
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT(channel_id, admin_id) DO UPDATE SET
+                    last_created_at = excluded.last_created_at,
+                    last_id = excluded.last_id,
+                    exported_at = excluded.exported_at
+            ''', (channel_id, admin_id, last[0], last[1], datetime.now()))
 
     async def is_blacklisted(self, user_id: int, channel_id: int) -> bool:
         return False
@@ -296,4 +880,4 @@ class Database:
         return False
 
 
-db = Database()
\ No newline at end of file
+db = Database()
@@ -1,5 +1,6 @@
 ﻿from aiogram import Router, F, Bot
 from aiogram.types import Message, CallbackQuery, BufferedInputFile
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError
 from aiogram.filters import Command, CommandStart
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
@@ -8,81 +9,26 @@ from aiogram.types import InlineKeyboardButton
 from database import db
 from keyboards import kb
 from config import config
+from services import welcome_queue, job_manager, export_requests, channel_meta
 import asyncio
-import time
-import csv
-import io
-from datetime import datetime
+import logging
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Optional
 
+logger = logging.getLogger(__name__)
 router = Router()
 
 
 class States(StatesGroup):
     waiting_accept_count = State()
     waiting_welcome = State()
+    waiting_export_range = State()
 
 
 def is_admin(user_id: int) -> bool:
     return user_id in config.ADMIN_IDS
 
 
-# === Кэш ===
-photo_cache: dict = {}
-info_cache: dict = {}
-CACHE_TTL = 300
-
-
-async def download_channel_photo(bot: Bot, channel_id: int) -> bytes | None:
-    try:
-        chat = await bot.get_chat(channel_id)
-        if chat.photo:
-            file = await bot.get_file(chat.photo.big_file_id)
-            photo_bytes = await bot.download_file(file.file_path)
-            return photo_bytes.read()
-    except Exception as e:
-        print(f"❌ Ошибка скачивания фото: {e}")
-    return None
-
-
-async def get_channel_photo_bytes(bot: Bot, channel_id: int) -> bytes | None:
-    now = time.time()
-    cache_key = f"photo_{channel_id}"
-
-    if cache_key in photo_cache:
-        cached = photo_cache[cache_key]
-        if cached.get('bytes') and now - cached['time'] < CACHE_TTL:
-            return cached['bytes']
-
-    photo_bytes = await download_channel_photo(bot, channel_id)
-
-    if photo_bytes:
-        photo_cache[cache_key] = {'bytes': photo_bytes, 'time': now}
-
-    return photo_bytes
-
-
-async def get_channel_info(bot: Bot, channel_id: int) -> dict:
-    now = time.time()
-
-    if channel_id in info_cache:
-        cached = info_cache[channel_id]
-        if now - cached['time'] < 60:
-            return cached['data']
-
-    try:
-        chat = await bot.get_chat(channel_id)
-        data = {
-            'title': chat.title,
-            'description': chat.description,
-            'members_count': chat.member_count if hasattr(chat, 'member_count') else None,
-        }
-        info_cache[channel_id] = {'data': data, 'time': now}
-    except:
-        data = {'title': None, 'description': None, 'members_count': None}
-
-    return data
-
-
 def build_channel_text(title: str, description: str | None, members: int | None,
                        pending: int, accepted: int, auto_accept: bool) -> str:
     lines = [f"<b>{title}</b>", ""]
@@ -103,13 +49,42 @@ def build_channel_text(title: str, description: str | None, members: int | None,
     return "\n".join(lines)
 
 
+async def send_card_photo(callback: CallbackQuery, bot: Bot, channel: dict, info: dict,
+                          text: str, menu) -> bool:
+    """Аватар по сохранённому file_id; байты качаем и загружаем только при первом показе или смене аватара"""
+    if channel.get('photo_unique_id') == info['photo_unique_id'] and channel.get('photo_file_id'):
+        try:
+            await callback.message.answer_photo(
+                photo=channel['photo_file_id'], caption=text, parse_mode="HTML", reply_markup=menu
+            )
+            return True
+        except TelegramBadRequest:
+            # file_id больше не принимается — загрузим заново
+            pass
+
+    photo_bytes = await channel_meta.download_photo(bot, info['photo_id'])
+    if not photo_bytes:
+        return False
+
+    try:
+        photo = BufferedInputFile(photo_bytes, filename="photo.jpg")
+        sent = await callback.message.answer_photo(photo=photo, caption=text, parse_mode="HTML", reply_markup=menu)
+    except Exception as e:
+        logger.warning(f"Ошибка отправки фото: {e}")
+        return False
+
+    await db.update_channel(
+        channel['channel_id'], photo_unique_id=info['photo_unique_id'], photo_file_id=sent.photo[-1].file_id
+    )
+    return True
+
+
 async def send_channel_card(callback: CallbackQuery, bot: Bot, channel_id: int):
-    channel, pending_count, stats, info, photo_bytes = await asyncio.gather(
+    channel, pending_count, stats, info = await asyncio.gather(
         db.get_channel(channel_id),
         db.get_pending_count(channel_id),
         db.get_total_stats(channel_id),
-        get_channel_info(bot, channel_id),
-        get_channel_photo_bytes(bot, channel_id)
+        channel_meta.get(bot, channel_id)
     )
 
     if not channel:
@@ -128,14 +103,9 @@ async def send_channel_card(callback: CallbackQuery, bot: Bot, channel_id: int):
     except:
         pass
 
-    if photo_bytes:
-        try:
-            photo = BufferedInputFile(photo_bytes, filename="photo.jpg")
-            await callback.message.answer_photo(photo=photo, caption=text, parse_mode="HTML", reply_markup=menu)
-            await callback.answer()
-            return
-        except Exception as e:
-            print(f"❌ Ошибка отправки фото: {e}")
+    if info['photo_unique_id'] and await send_card_photo(callback, bot, channel, info, text, menu):
+        await callback.answer()
+        return
 
     await callback.message.answer(text, parse_mode="HTML", reply_markup=menu)
     await callback.answer()
@@ -146,7 +116,7 @@ async def update_channel_card(callback: CallbackQuery, bot: Bot, channel_id: int
         db.get_channel(channel_id),
         db.get_pending_count(channel_id),
         db.get_total_stats(channel_id),
-        get_channel_info(bot, channel_id)
+        channel_meta.get(bot, channel_id)
     )
 
     if not channel:
@@ -197,38 +167,35 @@ async def cmd_stats(message: Message):
     if not is_admin(message.from_user.id):
         return
 
-    channels = await db.get_all_channels()
+    dashboard = await db.get_dashboard_stats()
 
-    if not channels:
+    if not dashboard['channels']:
         await message.answer("📊 Нет каналов")
         return
 
-    total_accepted = 0
-    total_pending = 0
     lines = ["📊 <b>Статистика</b>", ""]
 
-    for ch in channels:
-        stats = await db.get_total_stats(ch['channel_id'])
-        pending = await db.get_pending_count(ch['channel_id'])
-        total_accepted += stats['total_accepted']
-        total_pending += pending
-
+    for ch in dashboard['channels']:
         icon = "⚡" if ch['auto_accept'] else "✋"
         lines.append(f"{icon} <b>{ch['title'][:22]}</b>")
-        lines.append(f"   📬 {pending} ожидают • ✅ {stats['total_accepted']} принято")
+        lines.append(f"   📬 {ch['pending']} ожидают • ✅ {ch['total_accepted']} принято")
 
     lines.extend([
         "",
         "━━━━━━━━━━━━━━━",
-        f"📬 Всего ожидают: <b>{total_pending}</b>",
-        f"✅ Всего принято: <b>{total_accepted}</b>"
+        f"📬 Всего ожидают: <b>{dashboard['total_pending']}</b>",
+        f"✅ Всего принято: <b>{dashboard['total_accepted']}</b>",
+        f"📅 Принято сегодня: <b>{dashboard['today_accepted']}</b>",
+        f"✉️ Очередь приветствий: <b>{welcome_queue.depth}</b> ({welcome_queue.drain_rate:.1f}/с)",
+        f"🗂 Кэш каналов: {channel_meta.cache.hits} попаданий / {channel_meta.cache.misses} промахов / "
+        f"{channel_meta.cache.coalesced} ждали загрузку"
     ])
 
     await message.answer("\n".join(lines), parse_mode="HTML")
 
 
 @router.message(Command("accept"))
-async def cmd_accept(message: Message, bot: Bot):
+async def cmd_accept(message: Message):
     """Принятие: /accept <число> или /accept <число> <channel_id>"""
     if not is_admin(message.from_user.id):
         return
@@ -237,7 +204,7 @@ async def cmd_accept(message: Message, bot: Bot):
 
     if not args:
         # Показываем справку
-        channels = await db.get_all_channels()
+        channels = (await db.get_dashboard_stats())['channels']
 
         lines = [
             "📋 <b>Использование:</b>",
@@ -253,9 +220,8 @@ async def cmd_accept(message: Message, bot: Bot):
             lines.append("")
             lines.append("<b>Ваши каналы:</b>")
             for ch in channels:
-                pending = await db.get_pending_count(ch['channel_id'])
                 lines.append(f"• {ch['title'][:25]}")
-                lines.append(f"  ID: <code>{ch['channel_id']}</code> ({pending} ожидают)")
+                lines.append(f"  ID: <code>{ch['channel_id']}</code> ({ch['pending']} ожидают)")
 
         await message.answer("\n".join(lines), parse_mode="HTML")
         return
@@ -294,55 +260,20 @@ async def cmd_accept(message: Message, bot: Bot):
         return
     else:
         lines = ["📢 <b>Укажите канал:</b>", ""]
-        for ch in channels:
-            pending = await db.get_pending_count(ch['channel_id'])
+        for ch in (await db.get_dashboard_stats())['channels']:
             lines.append(f"<code>/accept {count_str} {ch['channel_id']}</code>")
-            lines.append(f"   {ch['title'][:25]} ({pending} ожидают)")
+            lines.append(f"   {ch['title'][:25]} ({ch['pending']} ожидают)")
             lines.append("")
         await message.answer("\n".join(lines), parse_mode="HTML")
         return
 
-    # Принимаем
-    pending = await db.get_pending_requests(channel_id)
-
-    if not pending:
+    # Принимаем в фоне
+    if not await db.get_pending_count(channel_id):
         await message.answer("📭 Нет заявок в этом канале")
         return
 
-    to_accept = pending if count is None else pending[:count]
-
-    msg = await message.answer(f"⏳ Принимаю {len(to_accept)} из {len(pending)}...")
-
-    success = 0
-    for req in to_accept:
-        try:
-            await bot.approve_chat_join_request(channel_id, req['user_id'])
-            await db.update_request(req['id'], 'accepted', message.from_user.id)
-            await db.increment_accepted(channel_id)
-            success += 1
-
-            if channel.get('welcome_message'):
-                try:
-                    await bot.send_message(req['user_id'], channel['welcome_message'], parse_mode="HTML")
-                except:
-                    pass
-        except:
-            pass
-
-    await db.update_stats(channel_id, accepted=success)
-
-    if channel_id in info_cache:
-        del info_cache[channel_id]
-
-    remaining = len(pending) - success
-
-    await msg.edit_text(
-        f"✅ <b>Готово!</b>\n\n"
-        f"📢 {channel['title']}\n"
-        f"👥 Принято: <b>{success}</b>\n"
-        f"📬 Осталось в очереди: <b>{remaining}</b>",
-        parse_mode="HTML"
-    )
+    if not await job_manager.submit(channel_id, count, message.from_user.id, message.chat.id):
+        await message.answer("⏳ В этом канале уже идёт приём")
 
 
 @router.message(Command("help"))
@@ -380,7 +311,9 @@ async def on_bot_added(update, bot: Bot):
         return
 
     if status in ['administrator', 'member']:
-        await db.save_discovered_channel(chat.id, chat.title)
+        # Права приходят в самом обновлении — меню добавления не перепроверяет их запросами
+        can_invite = status == 'administrator' and getattr(update.new_chat_member, 'can_invite_users', False)
+        await db.save_discovered_channel(chat.id, chat.title, bool(can_invite))
     elif status in ['left', 'kicked']:
         await db.mark_channel_removed(chat.id)
 
@@ -411,33 +344,55 @@ async def channels_list(callback: CallbackQuery):
     await send_new(callback, text, kb.channels_list(channels))
 
 
-@router.callback_query(F.data == "add_channel")
+async def probe_rights(bot: Bot, channel_ids: list[int]) -> dict[int, bool]:
+    """Права бота в каналах: параллельно, не больше PROBE_CONCURRENCY запросов разом"""
+    slots = asyncio.Semaphore(config.PROBE_CONCURRENCY)
+
+    async def probe(channel_id: int):
+        async with slots:
+            try:
+                member = await bot.get_chat_member(channel_id, bot.id)
+            except (TelegramBadRequest, TelegramForbiddenError):
+                # Бота нет в канале
+                return channel_id, False
+            except Exception:
+                # Сетевая ошибка: права неизвестны, проверим в следующий раз
+                return channel_id, None
+            return channel_id, member.status == 'administrator' and getattr(member, 'can_invite_users', False)
+
+    results = await asyncio.gather(*(probe(channel_id) for channel_id in channel_ids))
+    return {channel_id: bool(ok) for channel_id, ok in results if ok is not None}
+
+
+@router.callback_query(F.data.in_({"add_channel", "add_channel_refresh"}))
 async def add_channel_menu(callback: CallbackQuery, bot: Bot):
-    active_ids = {ch['channel_id'] for ch in await db.get_all_channels()}
-    discovered = await db.get_discovered_channels()
+    candidates = [ch for ch in await db.get_discovered_channels() if not ch['is_active']]
 
-    available = []
-    for ch in discovered:
-        if ch['channel_id'] in active_ids:
-            continue
-        try:
-            member = await bot.get_chat_member(ch['channel_id'], bot.id)
-            if member.status == 'administrator' and getattr(member, 'can_invite_users', False):
-                chat = await bot.get_chat(ch['channel_id'])
-                available.append({'id': ch['channel_id'], 'title': chat.title})
-        except:
-            continue
+    # Проверяем только каналы без сохранённых прав, а по кнопке «Обновить» — все
+    refresh = callback.data == "add_channel_refresh"
+    unknown = [ch['channel_id'] for ch in candidates if refresh or ch['can_invite'] is None]
+    if unknown:
+        rights = await probe_rights(bot, unknown)
+        await db.set_channel_rights(rights)
+        for ch in candidates:
+            ch['can_invite'] = rights.get(ch['channel_id'], ch['can_invite'])
+
+    available = [ch for ch in candidates if ch['can_invite']]
 
     builder = InlineKeyboardBuilder()
 
     if available:
         text = "📢 <b>Выберите канал</b>"
         for ch in available:
-            builder.row(InlineKeyboardButton(text=f"➕ {ch['title'][:35]}", callback_data=f"add:{ch['id']}"))
+            title = ch['title'] or str(ch['channel_id'])
+            builder.row(InlineKeyboardButton(text=f"➕ {title[:35]}", callback_data=f"add:{ch['channel_id']}"))
     else:
         text = "📢 <b>Нет каналов</b>\n\nДобавьте бота админом."
 
-    builder.row(InlineKeyboardButton(text="← Назад", callback_data="channels"))
+    builder.row(
+        InlineKeyboardButton(text="🔄 Обновить", callback_data="add_channel_refresh"),
+        InlineKeyboardButton(text="← Назад", callback_data="channels")
+    )
     await send_new(callback, text, builder.as_markup())
 
 
@@ -446,14 +401,9 @@ async def add_channel(callback: CallbackQuery, bot: Bot):
     channel_id = int(callback.data.split(":")[1])
 
     try:
-        chat = await bot.get_chat(channel_id)
-        await db.add_channel(channel_id, chat.title)
-
-        cache_key = f"photo_{channel_id}"
-        if cache_key in photo_cache:
-            del photo_cache[cache_key]
-        if channel_id in info_cache:
-            del info_cache[channel_id]
+        # Свежие метаданные сразу попадают в кэш и карточка ниже не запрашивает их снова
+        info = await channel_meta.fetch(bot, channel_id, refresh=True)
+        await db.add_channel(channel_id, info['title'])
 
         await callback.answer("✅ Добавлено!")
         await send_channel_card(callback, bot, channel_id)
@@ -490,43 +440,32 @@ async def accept_menu(callback: CallbackQuery):
 
 
 @router.callback_query(F.data.startswith("accept:"))
-async def accept_users(callback: CallbackQuery, bot: Bot):
+async def accept_users(callback: CallbackQuery):
     parts = callback.data.split(":")
     channel_id = int(parts[1])
     count = parts[2]
 
-    pending = await db.get_pending_requests(channel_id)
-    if not pending:
+    if not await db.get_pending_count(channel_id):
         await callback.answer("📭 Нет заявок", show_alert=True)
         return
 
-    to_accept = pending if count == "all" else pending[:int(count)]
-    await callback.answer(f"⏳ Принимаю {len(to_accept)}...")
+    target = None if count == "all" else int(count)
+    if not await job_manager.submit(channel_id, target, callback.from_user.id, callback.message.chat.id):
+        await callback.answer("⏳ В этом канале уже идёт приём", show_alert=True)
+        return
 
-    success = 0
-    channel = await db.get_channel(channel_id)
+    await callback.answer("⏳ Приём запущен")
 
-    for req in to_accept:
-        try:
-            await bot.approve_chat_join_request(channel_id, req['user_id'])
-            await db.update_request(req['id'], 'accepted', callback.from_user.id)
-            await db.increment_accepted(channel_id)
-            success += 1
-
-            if channel.get('welcome_message'):
-                try:
-                    await bot.send_message(req['user_id'], channel['welcome_message'], parse_mode="HTML")
-                except:
-                    pass
-        except:
-            pass
 
-    await db.update_stats(channel_id, accepted=success)
+@router.callback_query(F.data.startswith("job:"))
+async def job_control(callback: CallbackQuery):
+    _, job_id, action = callback.data.split(":")
 
-    if channel_id in info_cache:
-        del info_cache[channel_id]
+    if not await job_manager.control(int(job_id), action):
+        await callback.answer("Приём уже завершён", show_alert=True)
+        return
 
-    await update_channel_card(callback, bot, channel_id)
+    await callback.answer()
 
 
 @router.callback_query(F.data.startswith("accept_custom:"))
@@ -540,7 +479,7 @@ async def accept_custom(callback: CallbackQuery, state: FSMContext):
 
 
 @router.message(States.waiting_accept_count)
-async def process_accept_count(message: Message, state: FSMContext, bot: Bot):
+async def process_accept_count(message: Message, state: FSMContext):
     try:
         count = int(message.text)
         assert count > 0
@@ -552,38 +491,8 @@ async def process_accept_count(message: Message, state: FSMContext, bot: Bot):
     channel_id = data['channel_id']
     await state.clear()
 
-    pending = await db.get_pending_requests(channel_id)
-    to_accept = pending[:count]
-
-    msg = await message.answer(f"⏳ Принимаю {len(to_accept)}...")
-
-    success = 0
-    channel = await db.get_channel(channel_id)
-
-    for req in to_accept:
-        try:
-            await bot.approve_chat_join_request(channel_id, req['user_id'])
-            await db.update_request(req['id'], 'accepted', message.from_user.id)
-            await db.increment_accepted(channel_id)
-            success += 1
-
-            if channel.get('welcome_message'):
-                try:
-                    await bot.send_message(req['user_id'], channel['welcome_message'], parse_mode="HTML")
-                except:
-                    pass
-        except:
-            pass
-
-    await db.update_stats(channel_id, accepted=success)
-    await msg.delete()
-
-    if channel_id in info_cache:
-        del info_cache[channel_id]
-
-    channel = await db.get_channel(channel_id)
-    pending_count = await db.get_pending_count(channel_id)
-    await message.answer(f"✅ Принято: {success}", reply_markup=kb.channel_menu(channel, pending_count))
+    if not await job_manager.submit(channel_id, count, message.from_user.id, message.chat.id):
+        await message.answer("⏳ В этом канале уже идёт приём")
 
 
 # === Пиковые часы (inline кнопка в меню канала) ===
@@ -628,76 +537,202 @@ async def peak_hours(callback: CallbackQuery):
 
     lines.extend(["", f"📝 Всего заявок: <b>{total}</b>"])
 
-    await edit_menu(callback, "\n".join(lines), kb.back(f"ch:{channel_id}"))
+    await edit_menu(callback, "\n".join(lines), kb.peak_menu(channel_id))
+
+
+WEEKDAYS = ["Пн", "Вт", "Ср", "Чт", "Пт", "Сб", "Вс"]
+HEAT_LEVELS = " ░▒▓█"
+
+
+@router.callback_query(F.data.startswith("heat:"))
+async def peak_heatmap(callback: CallbackQuery):
+    channel_id = int(callback.data.split(":")[1])
+
+    cells = await db.get_weekly_hours(channel_id)
+
+    if not cells:
+        await callback.answer("📊 Недостаточно данных", show_alert=True)
+        return
+
+    peak = max(cells.values())
+    rows = ["   0     6     12    18"]
+    for day, name in enumerate(WEEKDAYS):
+        line = ""
+        for hour in range(24):
+            count = cells.get((day, hour), 0)
+            # Пустая клетка — только при нуле, любая активность видна хотя бы «░»
+            level = -(-count * (len(HEAT_LEVELS) - 1) // peak)
+            line += HEAT_LEVELS[level]
+        rows.append(f"{name} {line}")
+
+    (top_day, top_hour), top_count = max(cells.items(), key=lambda x: x[1])
+
+    lines = [
+        "🗓 <b>Заявки по дням недели и часам</b>",
+        "",
+        "<code>" + "\n".join(rows) + "</code>",
+        "",
+        f"🔥 Пик: <b>{WEEKDAYS[top_day]} {top_hour:02d}:00</b> — {top_count}",
+        f"📝 Всего заявок: <b>{sum(cells.values())}</b>",
+        "<i>Время UTC</i>",
+    ]
+
+    await edit_menu(callback, "\n".join(lines), kb.peak_menu(channel_id, heatmap=True))
 
 
 # === Экспорт в CSV (inline кнопка в меню канала) ===
 
 @router.callback_query(F.data.startswith("export:"))
-async def export_csv(callback: CallbackQuery):
-    channel_id = int(callback.data.split(":")[1])
+async def export_menu(callback: CallbackQuery):
+    parts = callback.data.split(":")
+    channel_id = int(parts[1])
+    fmt = parts[2] if len(parts) > 2 else "csv"
     channel = await db.get_channel(channel_id)
 
     if not channel:
         await callback.answer("❌ Канал не найден", show_alert=True)
         return
 
-    # Получаем все заявки канала
-    all_requests = await db.get_all_requests(channel_id)
+    mark = await db.get_export_mark(channel_id, callback.from_user.id)
+    last = f"до {mark['last_created_at']}" if mark else "ещё не было"
+
+    text = (
+        f"📥 <b>Экспорт: {channel['title']}</b>\n\n"
+        f"🆕 Прошлый экспорт: {last}\n"
+        f"Файлы больше 50 МБ придут частями.\n"
+        f"Сжатый CSV.gz обычно меньше в 5–10 раз."
+    )
+    await edit_menu(callback, text, kb.export_menu(channel_id, fmt))
+
+
+async def send_export(message: Message, channel: Dict, admin_id: int, fmt: str,
+                      after: tuple, until: Optional[str], period: str):
+    """Выгружает заявки из диапазона и отправляет файлы; продолжение с отметки сдвигает её"""
+    channel_id = channel['channel_id']
     stats = await db.get_total_stats(channel_id)
     pending = await db.get_pending_count(channel_id)
+    summary = [
+        ["=== СВОДКА ==="],
+        ["Канал", channel['title']],
+        ["Период", period],
+        ["Всего принято", stats['total_accepted']],
+        ["Ожидают", pending],
+        ["Дата экспорта", datetime.now().strftime("%Y-%m-%d %H:%M")],
+    ]
+
+    # Строки идут из курсора прямо во временные файлы
+    export = await export_requests(
+        channel['title'], db.iter_requests(channel_id, after, until), compress=fmt == "gz", summary=summary
+    )
 
-    # Создаём CSV
-    output = io.StringIO()
-    writer = csv.writer(output)
+    try:
+        if not export.rows:
+            await message.answer(f"📭 Нет заявок: {period}", reply_markup=kb.back(f"export:{channel_id}:{fmt}"))
+            return
 
-    # Заголовки
-    writer.writerow([
-        "ID пользователя", "Username", "Имя", "Статус",
-        "Дата заявки", "Дата обработки"
-    ])
+        caption = (
+            f"📊 <b>Экспорт: {channel['title']}</b>\n\n"
+            f"🗓 {period}\n"
+            f"📄 Строк: {export.rows}\n"
+            f"✅ Принято: {stats['total_accepted']}\n"
+            f"📬 Ожидают: {pending}"
+        )
+
+        for i, part in enumerate(export.parts, 1):
+            last = i == len(export.parts)
+            part_caption = caption
+            if len(export.parts) > 1:
+                part_caption += f"\n\n📦 Часть {i} из {len(export.parts)}"
+            await message.answer_document(
+                part,
+                caption=part_caption,
+                parse_mode="HTML",
+                reply_markup=kb.back(f"ch:{channel_id}") if last else None
+            )
+    finally:
+        export.close()
+
+    # Отметку двигает только выгрузка без пропуска: с отметки или раньше и до текущего момента.
+    # Иначе заявки между отметкой и началом диапазона не попали бы в следующий «с прошлого раза»
+    mark = await db.get_export_mark(channel_id, admin_id)
+    marked = (mark['last_created_at'], mark['last_id']) if mark else ('', 0)
+    if until is None and after <= marked < export.last:
+        await db.set_export_mark(channel_id, admin_id, export.last)
+
+
+@router.callback_query(F.data.startswith("exp:"))
+async def export_csv(callback: CallbackQuery):
+    _, channel_id, fmt, period = callback.data.split(":")
+    channel_id = int(channel_id)
+    channel = await db.get_channel(channel_id)
+
+    if not channel:
+        await callback.answer("❌ Канал не найден", show_alert=True)
+        return
+
+    after = ('', 0)
+    if period == "new":
+        mark = await db.get_export_mark(channel_id, callback.from_user.id)
+        if mark:
+            after = (mark['last_created_at'], mark['last_id'])
+        label = "с прошлого экспорта"
+    elif period == "all":
+        label = "всё время"
+    else:
+        # created_at хранится в UTC (CURRENT_TIMESTAMP)
+        since = datetime.utcnow() - timedelta(days=int(period))
+        after = (since.strftime("%Y-%m-%d %H:%M:%S"), 0)
+        label = f"последние {period} дн."
 
-    for req in all_requests:
-        writer.writerow([
-            req['user_id'],
-            req['username'] or "",
-            req['full_name'] or "",
-            req['status'],
-            req['created_at'],
-            req['processed_at'] or ""
-        ])
-
-    # Добавляем сводку
-    writer.writerow([])
-    writer.writerow(["=== СВОДКА ==="])
-    writer.writerow(["Канал", channel['title']])
-    writer.writerow(["Всего принято", stats['total_accepted']])
-    writer.writerow(["Ожидают", pending])
-    writer.writerow(["Дата экспорта", datetime.now().strftime("%Y-%m-%d %H:%M")])
-
-    output.seek(0)
-    csv_bytes = output.getvalue().encode('utf-8-sig')
-
-    filename = f"{channel['title'][:20]}_{datetime.now().strftime('%Y%m%d')}.csv"
-    # Убираем недопустимые символы из имени файла
-    filename = "".join(c for c in filename if c.isalnum() or c in "._- ")
-
-    file = BufferedInputFile(csv_bytes, filename=filename)
+    await callback.answer("⏳ Готовлю файл...")
 
     try:
         await callback.message.delete()
     except:
         pass
 
-    await callback.message.answer_document(
-        file,
-        caption=f"📊 <b>Экспорт: {channel['title']}</b>\n\n"
-                f"✅ Принято: {stats['total_accepted']}\n"
-                f"📬 Ожидают: {pending}",
-        parse_mode="HTML",
-        reply_markup=kb.back(f"ch:{channel_id}")
+    await send_export(callback.message, channel, callback.from_user.id, fmt, after, None, label)
+
+
+@router.callback_query(F.data.startswith("exp_range:"))
+async def export_range(callback: CallbackQuery, state: FSMContext):
+    _, channel_id, fmt = callback.data.split(":")
+
+    await state.update_data(channel_id=int(channel_id), fmt=fmt)
+    await state.set_state(States.waiting_export_range)
+    await edit_menu(
+        callback,
+        "🗓 Введите период через пробел:\n<code>01.10.2026 15.10.2026</code>",
+        kb.back(f"export:{channel_id}:{fmt}")
     )
-    await callback.answer()
+
+
+@router.message(States.waiting_export_range)
+async def process_export_range(message: Message, state: FSMContext):
+    try:
+        start, end = (datetime.strptime(d, "%d.%m.%Y") for d in message.text.split())
+        assert start <= end
+    except:
+        await message.answer("❌ Формат: ДД.ММ.ГГГГ ДД.ММ.ГГГГ")
+        return
+
+    data = await state.get_data()
+    await state.clear()
+
+    channel = await db.get_channel(data['channel_id'])
+    if not channel:
+        await message.answer("❌ Канал не найден")
+        return
+
+    # Даты — местные сутки, а created_at хранится в UTC; конец периода включительно: до начала следующего дня
+    since = start.astimezone(timezone.utc)
+    before = (end + timedelta(days=1)).astimezone(timezone.utc)
+    after = (since.strftime("%Y-%m-%d %H:%M:%S"), 0)
+    until = before.strftime("%Y-%m-%d %H:%M:%S")
+    label = f"{start:%d.%m.%Y} – {end:%d.%m.%Y}"
+
+    await message.answer("⏳ Готовлю файл...")
+    await send_export(message, channel, message.from_user.id, data['fmt'], after, until, label)
 
 
 # === Приветствие ===
@@ -753,33 +788,71 @@ async def process_welcome(message: Message, state: FSMContext):
 
 @router.callback_query(F.data == "stats_menu")
 async def stats_menu(callback: CallbackQuery):
-    channels = await db.get_all_channels()
+    dashboard = await db.get_dashboard_stats()
 
-    if not channels:
+    if not dashboard['channels']:
         await callback.answer("Нет каналов", show_alert=True)
         return
 
-    total = 0
     lines = ["📊 <b>Статистика</b>", ""]
 
-    for ch in channels:
-        stats = await db.get_total_stats(ch['channel_id'])
-        total += stats['total_accepted']
-        lines.append(f"• {ch['title'][:25]}: <b>{stats['total_accepted']}</b>")
+    for ch in dashboard['channels']:
+        lines.append(f"• {ch['title'][:25]}: <b>{ch['total_accepted']}</b>")
 
-    lines.extend(["", f"📈 Всего: <b>{total}</b>"])
+    lines.extend(["", f"📈 Всего: <b>{dashboard['total_accepted']}</b>"])
 
     await send_new(callback, "\n".join(lines), kb.back("menu"))
 
 
+CHART_DAYS = 91
+
+
 @router.callback_query(F.data.startswith("stat:"))
 async def channel_stats(callback: CallbackQuery):
     channel_id = int(callback.data.split(":")[1])
-    channel = await db.get_channel(channel_id)
-    stats = await db.get_total_stats(channel_id)
+    channel, stats, series = await asyncio.gather(
+        db.get_channel(channel_id),
+        db.get_total_stats(channel_id),
+        db.get_daily_series(channel_id, CHART_DAYS)
+    )
 
-    text = f"📊 <b>{channel['title']}</b>\n\n✅ Принято: <b>{stats['total_accepted']}</b>"
-    await edit_menu(callback, text, kb.back(f"ch:{channel_id}"))
+    days = {row['date']: row for row in series}
+    today = datetime.now().date()
+
+    # Недели по 7 дней, последняя заканчивается сегодня
+    weeks = []
+    for week in range(CHART_DAYS // 7 - 1, -1, -1):
+        end = today - timedelta(days=week * 7)
+        rows = [days.get(str(end - timedelta(days=d)), {}) for d in range(7)]
+        weeks.append((
+            end - timedelta(days=6),
+            sum(r.get('received', 0) for r in rows),
+            sum(r.get('accepted', 0) for r in rows)
+        ))
+
+    peak = max((received for _, received, _ in weeks), default=0) or 1
+    chart = []
+    for start, received, accepted in weeks:
+        bar_len = round(received / peak * 12)
+        chart.append(f"{start:%d.%m} {'█' * bar_len}{'░' * (12 - bar_len)} {received}/{accepted}")
+
+    total = {key: sum(row[key] for row in series) for key in ('received', 'accepted', 'expired', 'failed')}
+
+    lines = [
+        f"📊 <b>{channel['title']}</b>",
+        "",
+        f"✅ Принято всего: <b>{stats['total_accepted']}</b>",
+        "",
+        f"<b>За {CHART_DAYS // 7} недель:</b>",
+        f"📥 Поступило: <b>{total['received']}</b>",
+        f"✅ Принято: <b>{total['accepted']}</b>",
+        f"⌛ Неактуальны: <b>{total['expired']}</b>",
+        f"❌ Ошибки: <b>{total['failed']}</b>",
+        "",
+        "<b>По неделям</b> (поступило/принято):",
+        "<code>" + "\n".join(chart) + "</code>",
+    ]
+    await edit_menu(callback, "\n".join(lines), kb.back(f"ch:{channel_id}"))
 
 
 # === Настройки ===
@@ -3,10 +3,26 @@ from aiogram.types import ChatJoinRequest
 from aiogram.exceptions import TelegramBadRequest
 from database import db
 from config import config
+from services import welcome_queue, ingest_buffer
+from services.approval import GONE_ERRORS
 
 router = Router()
 
 
+async def approve_request(request: ChatJoinRequest, channel: dict) -> str:
+    """Одобряет заявку и ставит приветствие в очередь; исход — accepted, expired или failed"""
+    try:
+        await request.approve()
+    except TelegramBadRequest as e:
+        return 'expired' if any(code in e.message for code in GONE_ERRORS) else 'failed'
+    except:
+        return 'failed'
+
+    if channel.get('welcome_message'):
+        welcome_queue.put(request.from_user.id, channel['welcome_message'])
+    return 'accepted'
+
+
 @router.chat_join_request()
 async def handle_join_request(request: ChatJoinRequest, bot: Bot):
     """Обработка заявки на вступление"""
@@ -22,21 +38,23 @@ async def handle_join_request(request: ChatJoinRequest, bot: Bot):
         await db.add_channel(channel_id, request.chat.title)
         channel = await db.get_channel(channel_id)
 
+    if config.INGEST_BUFFER:
+        # Заявка и исход автоприёма попадут в БД общей пачкой
+        status = await approve_request(request, channel) if channel['auto_accept'] else 'pending'
+        ingest_buffer.add(user_id, username, full_name, channel_id, status)
+        return
+
     # Сохраняем заявку
     req_id = await db.add_request(user_id, username, full_name, channel_id)
 
     # Автоприём
-    if channel['auto_accept']:
-        try:
-            await request.approve()
-            await db.increment_accepted(channel_id)
-            await db.update_request(req_id, 'accepted', 0)
-            await db.update_stats(channel_id, accepted=1)
-
-            if channel.get('welcome_message'):
-                try:
-                    await bot.send_message(user_id, channel['welcome_message'], parse_mode="HTML")
-                except:
-                    pass
-        except:
-            pass
\ No newline at end of file
+    if not channel['auto_accept']:
+        return
+    status = await approve_request(request, channel)
+    if status == 'accepted':
+        await db.mark_accepted_many(channel_id, [req_id], 0)
+    elif status == 'expired':
+        await db.mark_requests_many([req_id], 'expired', 0)
+    else:
+        # Заявка остаётся в очереди, ошибку учитываем в сводке
+        await db.record_failed(channel_id, 1)
@@ -4,6 +4,7 @@ from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from database import db
 from keyboards import kb
+from services import job_manager
 
 router = Router()
 
@@ -73,8 +74,7 @@ async def set_batch_menu(callback: CallbackQuery):
     """Меню выбора количества для приёма"""
     channel_id = int(callback.data.split(":")[1])
 
-    pending = await db.get_pending_requests(channel_id)
-    pending_count = len(pending)
+    pending_count = await db.get_pending_count(channel_id)
 
     if pending_count == 0:
         await callback.answer("📭 Нет ожидающих заявок", show_alert=True)
@@ -90,56 +90,22 @@ async def set_batch_menu(callback: CallbackQuery):
 
 
 @router.callback_query(F.data.startswith("batch:"))
-async def process_batch(callback: CallbackQuery, bot: Bot):
+async def process_batch(callback: CallbackQuery):
     """Принять выбранное количество"""
     parts = callback.data.split(":")
     channel_id = int(parts[1])
     count = parts[2]
 
-    pending = await db.get_pending_requests(channel_id)
-
-    if not pending:
+    if not await db.get_pending_count(channel_id):
         await callback.answer("📭 Нет заявок", show_alert=True)
         return
 
-    if count == "all":
-        to_accept = pending
-    else:
-        to_accept = pending[:int(count)]
-
-    await safe_edit_or_send(callback, f"⏳ Принимаю {len(to_accept)} заявок...", None)
-
-    success = 0
-    channel = await db.get_channel(channel_id)
-
-    for req in to_accept:
-        try:
-            await bot.approve_chat_join_request(
-                chat_id=channel_id,
-                user_id=req['user_id']
-            )
-            await db.update_request(req['id'], 'accepted', callback.from_user.id)
-            await db.increment_accepted(channel_id)
-            success += 1
-
-            if channel and channel.get('welcome_message'):
-                try:
-                    await bot.send_message(
-                        req['user_id'],
-                        channel['welcome_message'],
-                        parse_mode="HTML"
-                    )
-                except:
-                    pass
-        except:
-            pass
-
-    await db.update_stats(channel_id, accepted=success)
-
-    await callback.answer(f"✅ Принято: {success}")
+    target = None if count == "all" else int(count)
+    if not await job_manager.submit(channel_id, target, callback.from_user.id, callback.message.chat.id):
+        await callback.answer("⏳ В этом канале уже идёт приём", show_alert=True)
+        return
 
-    from handlers.admin import show_channel_card
-    await show_channel_card(callback, bot, channel_id)
+    await callback.answer("⏳ Приём запущен")
 
 
 @router.callback_query(F.data.startswith("batch_custom:"))
@@ -147,22 +113,22 @@ async def batch_custom(callback: CallbackQuery, state: FSMContext):
     """Ввод своего количества"""
     channel_id = int(callback.data.split(":")[1])
 
-    pending = await db.get_pending_requests(channel_id)
+    pending_count = await db.get_pending_count(channel_id)
 
     await state.update_data(channel_id=channel_id)
     await state.set_state(SettingsStates.waiting_batch_count)
 
     text = (
         f"✏️ <b>Введите количество</b>\n\n"
-        f"Ожидают: {len(pending)}\n"
-        f"Отправьте число от 1 до {len(pending)}:"
+        f"Ожидают: {pending_count}\n"
+        f"Отправьте число от 1 до {pending_count}:"
     )
 
     await safe_edit_or_send(callback, text, kb.back_button(f"set_batch:{channel_id}"))
 
 
 @router.message(SettingsStates.waiting_batch_count)
-async def process_batch_count(message: Message, state: FSMContext, bot: Bot):
+async def process_batch_count(message: Message, state: FSMContext):
     """Обработка введённого количества"""
     try:
         count = int(message.text)
@@ -175,49 +141,10 @@ async def process_batch_count(message: Message, state: FSMContext, bot: Bot):
     data = await state.get_data()
     channel_id = data['channel_id']
 
-    pending = await db.get_pending_requests(channel_id)
-
-    if count > len(pending):
-        count = len(pending)
-
     await state.clear()
 
-    msg = await message.answer(f"⏳ Принимаю {count} заявок...")
-
-    success = 0
-    channel = await db.get_channel(channel_id)
-
-    for req in pending[:count]:
-        try:
-            await bot.approve_chat_join_request(
-                chat_id=channel_id,
-                user_id=req['user_id']
-            )
-            await db.update_request(req['id'], 'accepted', message.from_user.id)
-            await db.increment_accepted(channel_id)
-            success += 1
-
-            if channel and channel.get('welcome_message'):
-                try:
-                    await bot.send_message(req['user_id'], channel['welcome_message'], parse_mode="HTML")
-                except:
-                    pass
-        except:
-            pass
-
-    await db.update_stats(channel_id, accepted=success)
-
-    try:
-        await msg.delete()
-    except:
-        pass
-
-    channel = await db.get_channel(channel_id)
-    await message.answer(
-        f"✅ <b>Принято: {success}</b>",
-        parse_mode="HTML",
-        reply_markup=kb.channel_menu(channel)
-    )
+    if not await job_manager.submit(channel_id, count, message.from_user.id, message.chat.id):
+        await message.answer("⏳ В этом канале уже идёт приём")
 
 
 # ==========================================
@@ -216,6 +216,57 @@ class Keyboards:
         )
         return builder.as_markup()
 
+    @staticmethod
+    def peak_menu(channel_id: int, heatmap: bool = False) -> InlineKeyboardMarkup:
+        builder = InlineKeyboardBuilder()
+        if heatmap:
+            builder.row(InlineKeyboardButton(text="📈 По часам", callback_data=f"peak:{channel_id}"))
+        else:
+            builder.row(InlineKeyboardButton(text="🗓 По дням недели", callback_data=f"heat:{channel_id}"))
+        builder.row(InlineKeyboardButton(text="← Назад", callback_data=f"ch:{channel_id}"))
+        return builder.as_markup()
+
+    @staticmethod
+    def export_menu(channel_id: int, fmt: str = "csv") -> InlineKeyboardMarkup:
+        builder = InlineKeyboardBuilder()
+        prefix = f"exp:{channel_id}:{fmt}"
+
+        builder.row(
+            InlineKeyboardButton(text="📦 Всё", callback_data=f"{prefix}:all"),
+            InlineKeyboardButton(text="🆕 С прошлого раза", callback_data=f"{prefix}:new")
+        )
+        builder.row(
+            InlineKeyboardButton(text="📅 7 дней", callback_data=f"{prefix}:7"),
+            InlineKeyboardButton(text="📅 30 дней", callback_data=f"{prefix}:30")
+        )
+        builder.row(InlineKeyboardButton(text="🗓 Свой период", callback_data=f"exp_range:{channel_id}:{fmt}"))
+
+        if fmt == "gz":
+            fmt_btn = InlineKeyboardButton(text="Формат: 🗜 CSV.gz", callback_data=f"export:{channel_id}:csv")
+        else:
+            fmt_btn = InlineKeyboardButton(text="Формат: 📄 CSV", callback_data=f"export:{channel_id}:gz")
+        builder.row(fmt_btn)
+
+        builder.row(InlineKeyboardButton(text="← Назад", callback_data=f"ch:{channel_id}"))
+        return builder.as_markup()
+
+    @staticmethod
+    def job_controls(job: Dict) -> InlineKeyboardMarkup:
+        builder = InlineKeyboardBuilder()
+        jid = job['id']
+
+        if job['status'] == 'paused':
+            pause_btn = InlineKeyboardButton(text="▶️ Продолжить", callback_data=f"job:{jid}:resume")
+        else:
+            pause_btn = InlineKeyboardButton(text="⏸ Пауза", callback_data=f"job:{jid}:pause")
+
+        builder.row(pause_btn, InlineKeyboardButton(text="⏹ Отменить", callback_data=f"job:{jid}:cancel"))
+        builder.row(
+            InlineKeyboardButton(text="🐢 Медленнее", callback_data=f"job:{jid}:slower"),
+            InlineKeyboardButton(text="🐇 Быстрее", callback_data=f"job:{jid}:faster")
+        )
+        return builder.as_markup()
+
     @staticmethod
     def back(callback_data: str) -> InlineKeyboardMarkup:
         builder = InlineKeyboardBuilder()
@@ -0,0 +1,158 @@
+"""Локальная заглушка Telegram для проверки режима вебхука.
+
+Поднимает фейковый Bot API и шлёт боту заявки на вступление так же, как Telegram:
+
+    MODE=webhook BOT_TOKEN=123:fake BOT_API_URL=http://127.0.0.1:8081 WEBHOOK_SECRET=secret python bot.py
+    python scripts/fake_telegram.py --updates 1000 --secret secret
+
+С WORKERS=4 бот запускается супервизором; --channels раскладывает заявки по нескольким
+каналам (id -1001000000001, -1001000000002, ...), чтобы они попали разным воркерам.
+
+В конце печатает время ответа вебхука и задержку от отправки заявки до её одобрения.
+"""
+import argparse
+import asyncio
+import json
+import statistics
+import time
+from collections import Counter
+
+from aiohttp import ClientSession, web
+
+FIRST_CHANNEL = -1001000000001
+
+
+def channel(chat_id: int) -> dict:
+    return {"id": chat_id, "type": "channel", "title": f"Fake channel {FIRST_CHANNEL - chat_id + 1}"}
+
+
+class FakeTelegram:
+    """Bot API, который на всё отвечает успехом и запоминает, когда одобрена каждая заявка"""
+
+    def __init__(self):
+        self.calls = Counter()
+        self.posted = {}
+        self.approved = {}
+        self.message_id = 0
+
+    async def api(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        params = dict(await request.post())
+        self.calls[method] += 1
+
+        if method == "approveChatJoinRequest":
+            self.approved.setdefault(int(params["user_id"]), time.monotonic())
+        result = self._result(method, params)
+        return web.json_response({"ok": True, "result": result})
+
+    def _result(self, method: str, params: dict):
+        if method == "getMe":
+            return {"id": 1, "is_bot": True, "first_name": "Fake", "username": "fake_bot"}
+        if method == "getChat":
+            return channel(int(params.get("chat_id", FIRST_CHANNEL)))
+        if method in ("sendMessage", "sendPhoto", "sendDocument"):
+            self.message_id += 1
+            return {
+                "message_id": self.message_id, "date": int(time.time()),
+                "chat": {"id": int(params.get("chat_id", 0)), "type": "private"}, "text": params.get("text", ""),
+            }
+        return True
+
+
+def join_request(update_id: int, user_id: int, chat_id: int = FIRST_CHANNEL) -> dict:
+    return {
+        "update_id": update_id,
+        "chat_join_request": {
+            "chat": channel(chat_id),
+            "from": {"id": user_id, "is_bot": False, "first_name": f"User {user_id}"},
+            "user_chat_id": user_id,
+            "date": int(time.time()),
+        },
+    }
+
+
+def percentiles(values: list) -> str:
+    if not values:
+        return "—"
+    values = sorted(values)
+    p95 = values[min(len(values) - 1, int(len(values) * 0.95))]
+    return f"p50 {statistics.median(values) * 1000:.1f} мс, p95 {p95 * 1000:.1f} мс"
+
+
+async def wait_for_webhook(url: str, timeout: float = 60):
+    """Ждёт, пока бот поднимет сервер: любой HTTP-ответ на GET значит, что порт слушается"""
+    deadline = time.monotonic() + timeout
+    async with ClientSession() as session:
+        while True:
+            try:
+                async with session.get(url):
+                    return
+            except OSError:
+                if time.monotonic() > deadline:
+                    raise
+                await asyncio.sleep(0.2)
+
+
+async def post_updates(fake: FakeTelegram, args) -> list:
+    headers = {"Content-Type": "application/json"}
+    if args.secret:
+        headers["X-Telegram-Bot-Api-Secret-Token"] = args.secret
+
+    acks = []
+    statuses = Counter()
+    slots = asyncio.Semaphore(args.concurrency)
+
+    async def post(session: ClientSession, i: int):
+        user_id = args.first_user + i
+        update = join_request(i, user_id, FIRST_CHANNEL - i % args.channels)
+        async with slots:
+            fake.posted[user_id] = start = time.monotonic()
+            async with session.post(args.webhook, data=json.dumps(update), headers=headers) as r:
+                statuses[r.status] += 1
+            acks.append(time.monotonic() - start)
+
+    async with ClientSession() as session:
+        await asyncio.gather(*(post(session, i) for i in range(args.updates)))
+
+    print(f"Ответы вебхука: {dict(statuses)}, {percentiles(acks)}")
+    return acks
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--webhook", default="http://127.0.0.1:8080/webhook")
+    parser.add_argument("--secret", default="")
+    parser.add_argument("--api-port", type=int, default=8081)
+    parser.add_argument("--updates", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--channels", type=int, default=1)
+    parser.add_argument("--first-user", type=int, default=10_000)
+    parser.add_argument("--wait", type=float, default=60, help="сколько ждать одобрений, секунд")
+    args = parser.parse_args()
+
+    fake = FakeTelegram()
+    app = web.Application()
+    app.router.add_post("/bot{token}/{method}", fake.api)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", args.api_port).start()
+
+    try:
+        await wait_for_webhook(args.webhook)
+        started = time.monotonic()
+        await post_updates(fake, args)
+
+        deadline = time.monotonic() + args.wait
+        while len(fake.approved) < args.updates and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+
+        latencies = [fake.approved[u] - fake.posted[u] for u in fake.approved if u in fake.posted]
+        elapsed = time.monotonic() - started
+        print(f"Одобрено: {len(latencies)} из {args.updates} за {elapsed:.1f} с, {percentiles(latencies)}")
+        print(f"Вызовы Bot API: {dict(fake.calls)}")
+    finally:
+        await runner.cleanup()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,6 @@
+from .delivery import welcome_queue, DeliveryQueue
+from .ingest import ingest_buffer, IngestBuffer
+from .approval import engine, ApprovalEngine, ApprovalResult
+from .jobs import job_manager, JobManager
+from .export import export_requests, CsvExport, SpooledInputFile
+from .metadata import channel_meta, ChannelMetadata
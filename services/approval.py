@@ -0,0 +1,161 @@
+import asyncio
+import logging
+from collections import Counter
+from dataclasses import dataclass, field
+from typing import AsyncIterable, Awaitable, Callable, Dict, Iterable, List, Optional, Union
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramBadRequest
+
+from config import config
+from database import db
+from .delivery import welcome_queue
+
+logger = logging.getLogger(__name__)
+
+# Ответы Telegram, после которых заявки уже нет: её отозвали или пользователь уже в канале
+GONE_ERRORS = ('HIDE_REQUESTER_MISSING', 'USER_ALREADY_PARTICIPANT')
+
+
+@dataclass
+class ApprovalResult:
+    accepted: int = 0
+    expired: int = 0
+    failed: int = 0
+    errors: Counter = field(default_factory=Counter)
+
+    @property
+    def total(self) -> int:
+        return self.accepted + self.expired + self.failed
+
+    def summary(self) -> str:
+        parts = [f"✅ Принято: <b>{self.accepted}</b>"]
+        if self.expired:
+            parts.append(f"⌛ Неактуальны: <b>{self.expired}</b>")
+        if self.failed:
+            parts.append(f"❌ Ошибки: <b>{self.failed}</b>")
+        return "\n".join(parts)
+
+
+class _OutcomeBatch:
+    """Копит исходы заявок и сохраняет их пачками, а не транзакцией на каждую"""
+
+    def __init__(self, channel_id: int, processed_by: int, size: int):
+        self.channel_id = channel_id
+        self.processed_by = processed_by
+        self.size = size
+        self.ids: Dict[str, List[int]] = {'accepted': [], 'expired': []}
+
+    async def add(self, request_id: int, status: str):
+        self.ids[status].append(request_id)
+        if len(self.ids[status]) >= self.size:
+            await self.flush(status)
+
+    async def flush(self, *statuses: str):
+        for status in statuses or tuple(self.ids):
+            # Забираем пачку до await, чтобы воркеры продолжали копить следующую
+            ids, self.ids[status] = self.ids[status], []
+            if not ids:
+                continue
+            try:
+                if status == 'accepted':
+                    await db.mark_accepted_many(self.channel_id, ids, self.processed_by)
+                else:
+                    await db.mark_requests_many(ids, status, self.processed_by)
+            except Exception:
+                logger.exception(f"Не удалось сохранить {len(ids)} заявок ({status}) в {self.channel_id}")
+
+
+class ApprovalEngine:
+    """Одобрение заявок пачкой: ограниченный параллелизм и единый итог"""
+
+    def __init__(self, concurrency: int = config.APPROVE_CONCURRENCY,
+                 flush_size: int = config.APPROVE_FLUSH_SIZE):
+        self.concurrency = concurrency
+        self.flush_size = flush_size
+
+    async def approve(self, bot: Bot, channel_id: int, requests: Union[Iterable[Dict], AsyncIterable[Dict]],
+                      processed_by: int,
+                      welcome_message: Optional[str] = None, concurrency: Optional[int] = None,
+                      result: Optional[ApprovalResult] = None,
+                      throttle: Optional[Callable[[], Awaitable]] = None,
+                      stop: Optional[asyncio.Event] = None) -> ApprovalResult:
+        """Одобряет заявки; throttle ждёт перед каждым запросом, stop прерывает приём после текущих"""
+        # Свой result позволяет вызывающему увидеть частичный итог, если приём отменят
+        if result is None:
+            result = ApprovalResult()
+        batch = _OutcomeBatch(channel_id, processed_by, self.flush_size)
+        failed_before = result.failed
+        # Общий итератор: каждый воркер берёт следующую заявку, пока они не кончатся
+        next_request = self._shared_next(requests)
+
+        async def worker():
+            while (req := await next_request()) is not None:
+                if throttle:
+                    await throttle()
+                if stop is not None and stop.is_set():
+                    return
+                status = await self._approve_one(bot, channel_id, req, welcome_message, result)
+                if status:
+                    await batch.add(req['id'], status)
+
+        try:
+            await asyncio.gather(*(worker() for _ in range(concurrency or self.concurrency)))
+        finally:
+            # Уже одобренные заявки сохраняем и при отмене
+            await batch.flush()
+            if result.failed > failed_before:
+                await db.record_failed(channel_id, result.failed - failed_before)
+
+        if result.failed:
+            logger.warning(f"Ошибки приёма в {channel_id}: {dict(result.errors)}")
+
+        return result
+
+    @staticmethod
+    def _shared_next(requests: Union[Iterable[Dict], AsyncIterable[Dict]]) -> Callable[[], Awaitable]:
+        """Выдаёт заявки из обычного или асинхронного итератора по одной на всех воркеров"""
+        if hasattr(requests, '__aiter__'):
+            source = requests.__aiter__()
+            # Асинхронный генератор нельзя продолжать из двух корутин сразу
+            lock = asyncio.Lock()
+
+            async def next_async():
+                async with lock:
+                    return await anext(source, None)
+
+            return next_async
+
+        source = iter(requests)
+
+        async def next_sync():
+            return next(source, None)
+
+        return next_sync
+
+    async def _approve_one(self, bot: Bot, channel_id: int, req: Dict,
+                           welcome_message: Optional[str], result: ApprovalResult) -> Optional[str]:
+        """Одобряет одну заявку и возвращает её новый статус (None — осталась в очереди)"""
+        try:
+            await bot.approve_chat_join_request(channel_id, req['user_id'])
+        except TelegramBadRequest as e:
+            result.errors[e.message] += 1
+            if any(code in e.message for code in GONE_ERRORS):
+                result.expired += 1
+                return 'expired'
+            result.failed += 1
+            return None
+        except Exception as e:
+            result.errors[type(e).__name__] += 1
+            result.failed += 1
+            return None
+
+        result.accepted += 1
+
+        if welcome_message:
+            welcome_queue.put(req['user_id'], welcome_message)
+
+        return 'accepted'
+
+
+engine = ApprovalEngine()
@@ -0,0 +1,89 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import List, Optional, Tuple
+
+from aiogram import Bot
+
+from config import config
+from utils import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+# Окно, по которому считается скорость разбора очереди
+DRAIN_WINDOW = 60
+
+
+class DeliveryQueue:
+    """Фоновая доставка приветствий: своя очередь, воркеры и бюджет запросов"""
+
+    def __init__(self, workers: int = config.WELCOME_WORKERS, rate: float = config.WELCOME_RATE,
+                 maxsize: int = config.WELCOME_QUEUE_SIZE):
+        self.workers = workers
+        self.bucket = TokenBucket(rate)
+        self.queue: asyncio.Queue[Tuple[int, str]] = asyncio.Queue(maxsize)
+        self.sent = 0
+        self.failed = 0
+        self.dropped = 0
+        self._delivered: deque = deque()
+        self._tasks: List[asyncio.Task] = []
+        self._bot: Optional[Bot] = None
+
+    def start(self, bot: Bot):
+        self._bot = bot
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self, timeout: float = 10):
+        """Даёт очереди догрузиться и останавливает воркеров"""
+        if self._tasks:
+            try:
+                await asyncio.wait_for(self.queue.join(), timeout)
+            except asyncio.TimeoutError:
+                logger.warning(f"✉️ Не доставлено приветствий при остановке: {self.depth}")
+
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def put(self, user_id: int, text: str) -> bool:
+        try:
+            self.queue.put_nowait((user_id, text))
+            return True
+        except asyncio.QueueFull:
+            self.dropped += 1
+            return False
+
+    @property
+    def depth(self) -> int:
+        return self.queue.qsize()
+
+    @property
+    def drain_rate(self) -> float:
+        """Доставлено сообщений в секунду за последнюю минуту"""
+        self._trim()
+        return len(self._delivered) / DRAIN_WINDOW
+
+    def _trim(self):
+        border = time.monotonic() - DRAIN_WINDOW
+        while self._delivered and self._delivered[0] < border:
+            self._delivered.popleft()
+
+    async def _worker(self):
+        while True:
+            user_id, text = await self.queue.get()
+            try:
+                await self.bucket.acquire()
+                await self._bot.send_message(user_id, text, parse_mode="HTML")
+                self.sent += 1
+                self._delivered.append(time.monotonic())
+                self._trim()
+            except Exception:
+                # Пользователь мог запретить боту писать ему — это не ошибка приёма
+                self.failed += 1
+            finally:
+                self.queue.task_done()
+
+
+welcome_queue = DeliveryQueue()
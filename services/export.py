@@ -0,0 +1,145 @@
+import codecs
+import csv
+import gzip
+import io
+from datetime import datetime
+from tempfile import SpooledTemporaryFile
+from typing import AsyncGenerator, AsyncIterable, Dict, List, Optional
+
+from aiogram import Bot
+from aiogram.types.input_file import InputFile
+
+from config import config
+
+HEADER = ["ID пользователя", "Username", "Имя", "Статус", "Дата заявки", "Дата обработки"]
+# Сколько сжатых данных может ждать в буфере компрессора: ближе к границе части сбрасываем его
+GZIP_SLACK = 256 * 1024
+# Блок с очередной строкой после сброса, финальный блок и трейлер gzip
+GZIP_TAIL = 64
+
+
+class SpooledInputFile(InputFile):
+    """Файл для отправки из SpooledTemporaryFile: читается кусками, а не целиком"""
+
+    def __init__(self, file: SpooledTemporaryFile, filename: str):
+        super().__init__(filename=filename)
+        self.file = file
+
+    async def read(self, bot: Bot) -> AsyncGenerator[bytes, None]:
+        # С начала при каждом чтении: запрос могут повторить после 429
+        self.file.seek(0)
+        while chunk := self.file.read(self.chunk_size):
+            yield chunk
+
+    def close(self):
+        self.file.close()
+
+
+class CsvExport:
+    """Потоковая выгрузка CSV: строки пишутся в temp-файлы, каждый не больше part_size"""
+
+    def __init__(self, filename: str, compress: bool = False,
+                 part_size: int = config.EXPORT_PART_SIZE, spool_size: int = config.EXPORT_SPOOL_SIZE):
+        self.filename = filename
+        self.compress = compress
+        self.part_size = part_size
+        self.spool_size = spool_size
+        self.parts: List[SpooledInputFile] = []
+        self.rows = 0
+        # Ключ (created_at, id) последней выгруженной заявки
+        self.last: Optional[tuple] = None
+        self._line = io.StringIO()
+        self._writer = csv.writer(self._line)
+        self._raw: Optional[SpooledTemporaryFile] = None
+        self._stream = None
+        self._part_rows = 0
+
+    def _open_part(self):
+        self._raw = SpooledTemporaryFile(max_size=self.spool_size)
+        self._stream = gzip.GzipFile(fileobj=self._raw, mode='wb') if self.compress else self._raw
+        # BOM в каждой части, чтобы Excel открыл кириллицу
+        self._stream.write(codecs.BOM_UTF8 + self._encode(HEADER))
+        self._part_rows = 0
+
+    def _close_part(self):
+        if self.compress:
+            self._stream.close()
+        self.parts.append(SpooledInputFile(self._raw, ''))
+        self._raw = self._stream = None
+
+    def _encode(self, row: list) -> bytes:
+        self._writer.writerow(row)
+        data = self._line.getvalue().encode('utf-8')
+        self._line.seek(0)
+        self._line.truncate()
+        return data
+
+    def _fits(self, size: int) -> bool:
+        """Поместятся ли ещё size байт в текущую часть"""
+        if not self.compress:
+            return self._raw.tell() + size <= self.part_size
+        if self._raw.tell() + size + GZIP_SLACK <= self.part_size:
+            return True
+        # Сжатый поток отстаёт от tell() на буфер компрессора: после сброса размер точный
+        self._stream.flush()
+        return self._raw.tell() + size + GZIP_TAIL <= self.part_size
+
+    def write(self, row: list):
+        data = self._encode(row)
+        # Строка, которая не влезает даже в пустую часть, всё равно уходит целиком
+        if self._raw is not None and self._part_rows and not self._fits(len(data)):
+            self._close_part()
+        if self._raw is None:
+            self._open_part()
+        self._stream.write(data)
+        self._part_rows += 1
+
+    def write_request(self, req: Dict):
+        self.rows += 1
+        self.last = (req['created_at'], req['id'])
+        self.write([
+            req['user_id'],
+            req['username'] or "",
+            req['full_name'] or "",
+            req['status'],
+            req['created_at'],
+            req['processed_at'] or ""
+        ])
+
+    def finish(self, summary: List[list]) -> List[SpooledInputFile]:
+        """Дописывает сводку в последнюю часть и раздаёт частям имена"""
+        self.write([])
+        for row in summary:
+            self.write(row)
+        if self._raw is not None:
+            self._close_part()
+
+        ext = ".csv.gz" if self.compress else ".csv"
+        for i, part in enumerate(self.parts, 1):
+            suffix = f"_part{i}" if len(self.parts) > 1 else ""
+            part.filename = f"{self.filename}{suffix}{ext}"
+        return self.parts
+
+    def close(self):
+        for part in self.parts:
+            part.close()
+        if self._raw is not None:
+            self._raw.close()
+
+
+async def export_requests(title: str, rows: AsyncIterable[Dict], compress: bool = False,
+                          summary: Optional[List[list]] = None) -> CsvExport:
+    """Выгружает заявки в части CSV; память не зависит от числа строк"""
+    filename = f"{title[:20]}_{datetime.now().strftime('%Y%m%d')}"
+    # Убираем недопустимые символы из имени файла
+    filename = "".join(c for c in filename if c.isalnum() or c in "._- ")
+
+    export = CsvExport(filename, compress)
+    try:
+        async for req in rows:
+            export.write_request(req)
+        export.finish(summary or [])
+    except BaseException:
+        export.close()
+        raise
+    return export
@@ -0,0 +1,69 @@
+import asyncio
+import logging
+from typing import List, Optional
+
+from config import config
+from database import db
+
+logger = logging.getLogger(__name__)
+
+
+class IngestBuffer:
+    """Write-behind буфер входящих заявок: копит строки и пишет их одной транзакцией"""
+
+    def __init__(self, max_rows: int = config.INGEST_BATCH_SIZE, max_delay: float = config.INGEST_FLUSH_DELAY):
+        self.max_rows = max_rows
+        self.max_delay = max_delay
+        self.rows: List[tuple] = []
+        self._has_rows = asyncio.Event()
+        self._full = asyncio.Event()
+        self._lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+        self._closing = False
+
+    def start(self):
+        self._closing = False
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Останавливает фоновый сброс и дописывает остаток"""
+        # Не отменяем задачу: отмена посреди транзакции откатила бы пачку
+        self._closing = True
+        self._has_rows.set()
+        self._full.set()
+        if self._task:
+            await self._task
+            self._task = None
+        await self.flush()
+
+    def add(self, user_id: int, username: str, full_name: str, channel_id: int, status: str = 'pending'):
+        """status — исход автоприёма: pending (не было), accepted, expired или failed"""
+        self.rows.append((user_id, username, full_name, channel_id, status))
+        self._has_rows.set()
+        if len(self.rows) >= self.max_rows:
+            self._full.set()
+
+    async def flush(self):
+        async with self._lock:
+            rows, self.rows = self.rows, []
+            self._has_rows.clear()
+            self._full.clear()
+            if not rows:
+                return
+            try:
+                await db.add_requests_many(rows)
+            except Exception:
+                logger.exception(f"Не удалось записать пачку из {len(rows)} заявок")
+
+    async def _run(self):
+        while not self._closing:
+            await self._has_rows.wait()
+            # Ждём, пока наберётся пачка, но не дольше max_delay
+            try:
+                await asyncio.wait_for(self._full.wait(), self.max_delay)
+            except asyncio.TimeoutError:
+                pass
+            await self.flush()
+
+
+ingest_buffer = IngestBuffer()
@@ -0,0 +1,306 @@
+import asyncio
+import logging
+import time
+from typing import Dict, Optional, Set
+
+from aiogram import Bot
+
+from config import config
+from database import db
+from keyboards import kb
+from utils import TokenBucket, owns_channel
+from .approval import engine, ApprovalResult
+
+logger = logging.getLogger(__name__)
+
+FINISHED = ('done', 'failed', 'cancelled')
+# Ступени темпа в заявках в секунду; None — без ограничения
+RATE_STEPS = (1, 2, 5, 10, 20, None)
+CONTROL_POLL = 1.0
+
+
+class JobControl:
+    """Управление идущим заданием: стоп-сигнал для воркеров и темп приёма"""
+
+    def __init__(self, rate: Optional[float] = None):
+        self.stop = asyncio.Event()
+        self.rate = None
+        # Итог пачки в работе: в БД он попадёт только после её окончания
+        self.batch: Optional[ApprovalResult] = None
+        self._bucket: Optional[TokenBucket] = None
+        self.set_rate(rate)
+
+    def set_rate(self, rate: Optional[float]):
+        if rate == self.rate:
+            return
+        self.rate = rate
+        self._bucket = TokenBucket(rate, capacity=1) if rate else None
+
+    async def throttle(self):
+        if self._bucket:
+            await self._bucket.acquire()
+
+
+def shift_rate(rate: Optional[float], step: int) -> Optional[float]:
+    """Соседняя ступень темпа: step=-1 медленнее, step=1 быстрее"""
+    index = RATE_STEPS.index(rate) if rate in RATE_STEPS else len(RATE_STEPS) - 1
+    return RATE_STEPS[max(0, min(len(RATE_STEPS) - 1, index + step))]
+
+
+async def format_job(job: Dict) -> str:
+    channel = await db.get_channel(job['channel_id']) or {}
+    result = ApprovalResult(accepted=job['accepted'], expired=job['expired'], failed=job['failed'])
+    target = "всех" if job['target'] is None else job['target']
+
+    if job['status'] == 'done':
+        header = "✅ <b>Готово!</b>"
+    elif job['status'] == 'failed':
+        header = "❌ <b>Приём прерван ошибкой</b>"
+    elif job['status'] == 'cancelled':
+        header = "⏹ <b>Приём остановлен</b>"
+    elif job['status'] == 'paused':
+        header = "⏸ <b>Приём на паузе</b>"
+    else:
+        header = "⏳ <b>Принимаю заявки...</b>"
+
+    lines = [
+        header,
+        "",
+        f"📢 {channel.get('title', job['channel_id'])}",
+        f"👥 Обработано: <b>{job['processed']}</b> из {target}",
+        result.summary(),
+    ]
+
+    if job['status'] not in FINISHED:
+        rate = f"{job['rate']:g}/сек" if job.get('rate') else "без ограничения"
+        lines.append(f"🚦 Темп: {rate}")
+    else:
+        pending = await db.get_pending_count(job['channel_id'])
+        lines.append(f"📬 Осталось в очереди: <b>{pending}</b>")
+
+    return "\n".join(lines)
+
+
+class JobManager:
+    """Массовый приём фоновыми заданиями: курсор и счётчики живут в таблице jobs"""
+
+    def __init__(self, batch_size: int = config.JOB_BATCH_SIZE,
+                 progress_interval: float = config.JOB_PROGRESS_INTERVAL):
+        self.batch_size = batch_size
+        self.progress_interval = progress_interval
+        self.tasks: Dict[int, asyncio.Task] = {}
+        self.controls: Dict[int, JobControl] = {}
+        # Каналы, где этот процесс сейчас массово принимает заявки: задания и запуски по расписанию
+        self.busy_channels: Set[int] = set()
+        self._bot: Optional[Bot] = None
+        self._adopter: Optional[asyncio.Task] = None
+
+    async def start(self, bot: Bot):
+        """Продолжает задания, прерванные перезапуском"""
+        self._bot = bot
+        for job in await db.get_jobs('running', 'paused'):
+            if owns_channel(job['channel_id']):
+                logger.info(f"🔁 Продолжаю задание #{job['id']} с позиции {job['processed']}")
+                self._spawn(job)
+        # Воркер подхватывает задания своих каналов, поставленные другим процессом
+        if config.WORKER_INDEX >= 0:
+            self._adopter = asyncio.create_task(self._adopt())
+
+    async def stop(self):
+        if self._adopter:
+            self._adopter.cancel()
+        # В БД задания сохраняют статус и продолжатся при следующем запуске
+        for task in self.tasks.values():
+            task.cancel()
+        await asyncio.gather(*self.tasks.values(), return_exceptions=True)
+
+    async def submit(self, channel_id: int, target: Optional[int], created_by: int, chat_id: int) -> Optional[Dict]:
+        """Ставит приём в фон; None, если в канале уже идёт задание"""
+        if await db.get_active_job(channel_id):
+            return None
+
+        message = await self._bot.send_message(chat_id, "⏳ Принимаю заявки...")
+        job = await db.create_job(channel_id, target, created_by, chat_id, message.message_id)
+        if job is None:
+            # Параллельный запуск успел первым — его уникальный индекс и остановил этот
+            try:
+                await self._bot.delete_message(chat_id, message.message_id)
+            except:
+                pass
+            return None
+        # Чужой канал запустит его воркер, увидев задание в БД
+        if owns_channel(channel_id):
+            self._spawn(job)
+        return job
+
+    async def control(self, job_id: int, action: str) -> Optional[Dict]:
+        """pause / resume / cancel / slower / faster; None, если задание уже завершено"""
+        job = await db.get_job(job_id)
+        if not job or job['status'] in FINISHED:
+            return None
+
+        if action == 'pause' and job['status'] == 'running':
+            job = await db.set_job_status(job_id, 'paused')
+        elif action == 'resume' and job['status'] == 'paused':
+            job = await db.set_job_status(job_id, 'running')
+        elif action == 'cancel':
+            job = await db.set_job_status(job_id, 'cancelled')
+        elif action in ('slower', 'faster'):
+            job = await db.set_job_rate(job_id, shift_rate(job['rate'], -1 if action == 'slower' else 1))
+
+        # Своему заданию применяем сразу, не дожидаясь опроса БД
+        control = self.controls.get(job_id)
+        if control:
+            self._apply(control, job)
+        await self._report(job)
+        return job
+
+    def _spawn(self, job: Dict):
+        # submit и опрос _adopt могут увидеть одно и то же новое задание
+        if job['id'] in self.tasks:
+            return
+        self.controls[job['id']] = JobControl(job['rate'])
+        task = asyncio.create_task(self._run(job))
+        self.tasks[job['id']] = task
+
+        def cleanup(_):
+            self.tasks.pop(job['id'], None)
+            self.controls.pop(job['id'], None)
+
+        task.add_done_callback(cleanup)
+
+    def claim_channel(self, channel_id: int) -> bool:
+        """Занимает канал под массовый приём; False — там уже идёт задание или расписание"""
+        if channel_id in self.busy_channels:
+            return False
+        self.busy_channels.add(channel_id)
+        return True
+
+    def release_channel(self, channel_id: int):
+        self.busy_channels.discard(channel_id)
+
+    async def _adopt(self):
+        while True:
+            await asyncio.sleep(CONTROL_POLL)
+            try:
+                for job in await db.get_jobs('running', 'paused'):
+                    if job['id'] not in self.tasks and owns_channel(job['channel_id']):
+                        logger.info(f"📥 Беру задание #{job['id']}")
+                        self._spawn(job)
+            except Exception:
+                logger.exception("Не удалось проверить новые задания")
+
+    @staticmethod
+    def _apply(control: JobControl, job: Dict):
+        control.set_rate(job['rate'])
+        if job['status'] != 'running':
+            control.stop.set()
+
+    async def _watch(self, job_id: int, control: JobControl):
+        """Следит за статусом и темпом в БД и раз в progress_interval показывает прогресс"""
+        reported = time.monotonic()
+        while True:
+            await asyncio.sleep(CONTROL_POLL)
+            job = await db.get_job(job_id)
+            if not job:
+                continue
+            self._apply(control, job)
+            if job['status'] == 'running' and time.monotonic() - reported >= self.progress_interval:
+                await self._report(self._live(job, control.batch))
+                reported = time.monotonic()
+
+    @staticmethod
+    def _live(job: Dict, batch: Optional[ApprovalResult]) -> Dict:
+        """Счётчики задания вместе с ещё не сохранённой пачкой"""
+        if not batch:
+            return job
+        return dict(
+            job, processed=job['processed'] + batch.total, accepted=job['accepted'] + batch.accepted,
+            expired=job['expired'] + batch.expired, failed=job['failed'] + batch.failed
+        )
+
+    async def _wait_resume(self, job: Dict) -> Dict:
+        while job['status'] == 'paused':
+            await asyncio.sleep(CONTROL_POLL)
+            job = await db.get_job(job['id'])
+        return job
+
+    async def _run(self, job: Dict):
+        channel = await db.get_channel(job['channel_id']) or {}
+        control = self.controls[job['id']]
+        # Сразу показываем кнопки управления; дальше прогресс показывает _watch
+        await self._report(job)
+
+        # Идущий приём по расписанию взял бы те же заявки — ждём его окончания
+        while not self.claim_channel(job['channel_id']):
+            await asyncio.sleep(CONTROL_POLL)
+
+        watcher = asyncio.create_task(self._watch(job['id'], control))
+        try:
+            # Копия задания могла устареть, пока ждали канал
+            job = await db.get_job(job['id']) or job
+            while True:
+                if job['status'] == 'paused':
+                    await self._report(job)
+                    job = await self._wait_resume(job)
+                if job['status'] != 'running':
+                    break
+
+                control.stop.clear()
+                limit = self.batch_size
+                if job['target'] is not None:
+                    limit = min(limit, job['target'] - job['processed'])
+                if limit <= 0:
+                    break
+
+                batch = await db.get_pending_page(
+                    job['channel_id'], (job['cursor_created_at'], job['cursor_id']), limit
+                )
+                if not batch:
+                    break
+
+                result = control.batch = ApprovalResult()
+                cursor = (job['cursor_created_at'], job['cursor_id'])
+                try:
+                    await engine.approve(
+                        self._bot, job['channel_id'], batch, job['created_by'], channel.get('welcome_message'),
+                        result=result, throttle=control.throttle, stop=control.stop
+                    )
+                    if not control.stop.is_set():
+                        cursor = (batch[-1]['created_at'], batch[-1]['id'])
+                finally:
+                    # Даже прерванная пачка учитывается; курсор сдвигаем только за полной.
+                    # Пачку убираем до записи, чтобы _watch не сложил её с уже сохранёнными счётчиками
+                    control.batch = None
+                    job = await db.advance_job(
+                        job['id'], result.total, result.accepted, result.expired, result.failed, cursor
+                    )
+
+            if job['status'] == 'running':
+                job = await db.set_job_status(job['id'], 'done')
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception(f"Задание #{job['id']} упало")
+            job = await db.set_job_status(job['id'], 'failed')
+        finally:
+            watcher.cancel()
+            self.release_channel(job['channel_id'])
+
+        await self._report(job)
+
+    async def _report(self, job: Dict):
+        if job['status'] in FINISHED:
+            markup = kb.back(f"ch:{job['channel_id']}")
+        else:
+            markup = kb.job_controls(job)
+        try:
+            await self._bot.edit_message_text(
+                await format_job(job), chat_id=job['chat_id'], message_id=job['message_id'],
+                parse_mode="HTML", reply_markup=markup
+            )
+        except:
+            pass
+
+
+job_manager = JobManager()
@@ -0,0 +1,61 @@
+import logging
+from typing import Dict, Optional
+
+from aiogram import Bot
+
+from config import config
+from utils import AsyncCache
+
+logger = logging.getLogger(__name__)
+
+EMPTY_INFO = {'title': None, 'description': None, 'members_count': None, 'photo_id': None, 'photo_unique_id': None}
+
+
+class ChannelMetadata:
+    """Метаданные канала одним get_chat: название, описание, подписчики и ссылка на аватар"""
+
+    def __init__(self, ttl: float = config.INFO_CACHE_TTL, max_items: int = config.INFO_CACHE_ITEMS,
+                 max_bytes: int = config.INFO_CACHE_BYTES):
+        # Одновременные открытия карточки одного канала ждут один запрос
+        self.cache = AsyncCache(ttl, max_items, max_bytes)
+
+    @staticmethod
+    async def _load(bot: Bot, channel_id: int) -> Dict:
+        chat = await bot.get_chat(channel_id)
+        return {
+            'title': chat.title,
+            'description': chat.description,
+            'members_count': chat.member_count if hasattr(chat, 'member_count') else None,
+            'photo_id': chat.photo.big_file_id if chat.photo else None,
+            'photo_unique_id': chat.photo.big_file_unique_id if chat.photo else None,
+        }
+
+    async def fetch(self, bot: Bot, channel_id: int, refresh: bool = False) -> Dict:
+        """Метаданные из кэша или Bot API; ошибки get_chat пробрасываются"""
+        if refresh:
+            self.cache.pop(channel_id)
+        return dict(await self.cache.get_or_load(channel_id, lambda: self._load(bot, channel_id)))
+
+    async def get(self, bot: Bot, channel_id: int) -> Dict:
+        """То же, но при ошибке — пустые поля, чтобы карточка открылась из данных БД"""
+        try:
+            return await self.fetch(bot, channel_id)
+        except Exception as e:
+            logger.warning(f"get_chat {channel_id}: {e}")
+            return dict(EMPTY_INFO)
+
+    def invalidate(self, channel_id: int):
+        self.cache.pop(channel_id)
+
+    @staticmethod
+    async def download_photo(bot: Bot, file_id: str) -> Optional[bytes]:
+        try:
+            file = await bot.get_file(file_id)
+            photo_bytes = await bot.download_file(file.file_path)
+            return photo_bytes.read()
+        except Exception as e:
+            logger.warning(f"Ошибка скачивания фото: {e}")
+        return None
+
+
+channel_meta = ChannelMetadata()
@@ -0,0 +1,225 @@
+﻿import asyncio
+import json
+import logging
+import os
+import secrets
+import signal
+import sys
+from typing import List, Optional
+
+import aiohttp
+from aiogram import Bot, Dispatcher
+from aiohttp import web
+
+from config import config
+from database import db
+from utils import shard_of, webhook_secret_ok, SECRET_HEADER
+
+logger = logging.getLogger(__name__)
+
+BOT_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bot.py")
+# Обновления, привязанные к каналу; остальные (админка, кнопки) обслуживает воркер 0
+CHANNEL_UPDATES = ('chat_join_request', 'my_chat_member', 'chat_member', 'channel_post', 'edited_channel_post')
+RESTART_DELAY = 1.0
+FORWARD_RETRIES = 50
+FORWARD_RETRY_DELAY = 0.2
+STOP_TIMEOUT = 30
+
+
+async def until_signal(coro, *signals: int):
+    """Выполняет coro до первого из сигналов; повторный сигнал не прерывает остановку"""
+    loop = asyncio.get_running_loop()
+    stop = asyncio.Event()
+    for sig in signals:
+        loop.add_signal_handler(sig, stop.set)
+
+    task = asyncio.create_task(coro)
+    stopper = asyncio.create_task(stop.wait())
+    try:
+        await asyncio.wait({task, stopper}, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        stopper.cancel()
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+
+
+def route_update(update: dict, workers: int = config.WORKERS) -> int:
+    """Номер воркера для обновления"""
+    for key in CHANNEL_UPDATES:
+        event = update.get(key)
+        if event:
+            return shard_of(event['chat']['id'], workers)
+    return 0
+
+
+class Supervisor:
+    """Процессы-воркеры на одной БД и пересылка им обновлений по владельцу канала"""
+
+    def __init__(self, workers: int = config.WORKERS):
+        self.workers = workers
+        # Порты воркеров принимают обновления только от супервизора
+        self.secret = secrets.token_urlsafe(24)
+        self.processes: List[Optional[asyncio.subprocess.Process]] = [None] * workers
+        self.forwarded = [0] * workers
+        self._tasks: List[asyncio.Task] = []
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._stopping = False
+
+    def _env(self, index: int) -> dict:
+        env = dict(os.environ)
+        env.update(
+            MODE="webhook", WEBHOOK_URL="", WEBHOOK_HOST="127.0.0.1",
+            WEBHOOK_PORT=str(config.WORKER_PORT + index), WEBHOOK_SECRET=self.secret,
+            WORKERS=str(self.workers), WORKER_INDEX=str(index),
+        )
+        return env
+
+    async def start(self):
+        self._session = aiohttp.ClientSession()
+        self._tasks = [asyncio.create_task(self._keep_alive(i)) for i in range(self.workers)]
+
+    async def stop(self):
+        self._stopping = True
+        for process in self.processes:
+            if process and process.returncode is None:
+                # Воркер доработает принятые обновления и сохранит задания
+                process.send_signal(signal.SIGTERM)
+
+        for process in self.processes:
+            if not process:
+                continue
+            try:
+                await asyncio.wait_for(process.wait(), STOP_TIMEOUT)
+            except asyncio.TimeoutError:
+                process.kill()
+                await process.wait()
+
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        if self._session:
+            await self._session.close()
+        logger.info(f"Супервизор: переслано по воркерам {self.forwarded}")
+
+    async def _keep_alive(self, index: int):
+        """Держит воркер запущенным: упавший перезапускается"""
+        while True:
+            process = await asyncio.create_subprocess_exec(sys.executable, BOT_SCRIPT, env=self._env(index))
+            self.processes[index] = process
+            logger.info(f"⚙️ Воркер {index} запущен (pid {process.pid}, порт {config.WORKER_PORT + index})")
+
+            code = await process.wait()
+            if self._stopping:
+                return
+            logger.warning(f"Воркер {index} завершился с кодом {code}, перезапускаю")
+            await asyncio.sleep(RESTART_DELAY)
+
+    async def forward(self, update: dict, body: Optional[bytes] = None) -> bool:
+        """Отдаёт обновление воркеру-владельцу; False — тот так и не ответил"""
+        index = route_update(update, self.workers)
+        url = f"http://127.0.0.1:{config.WORKER_PORT + index}{config.WEBHOOK_PATH}"
+        if body is None:
+            body = json.dumps(update, ensure_ascii=False).encode()
+        headers = {SECRET_HEADER: self.secret, "Content-Type": "application/json"}
+
+        for _ in range(FORWARD_RETRIES):
+            try:
+                async with self._session.post(url, data=body, headers=headers) as response:
+                    if response.status == 200:
+                        self.forwarded[index] += 1
+                        return True
+            except aiohttp.ClientError:
+                pass
+            # Воркер ещё стартует или перезапускается
+            await asyncio.sleep(FORWARD_RETRY_DELAY)
+
+        logger.error(f"Воркер {index} не принял обновление {update.get('update_id')}")
+        return False
+
+    async def handle(self, request: web.Request) -> web.Response:
+        if not webhook_secret_ok(request.headers, config.WEBHOOK_SECRET):
+            return web.Response(status=401)
+        body = await request.read()
+        # Не доставили — Telegram повторит обновление позже
+        ok = await self.forward(json.loads(body), body)
+        return web.Response(status=200 if ok else 503)
+
+    async def run_webhook(self, bot: Bot, allowed_updates: List[str]):
+        app = web.Application()
+        app.router.add_post(config.WEBHOOK_PATH, self.handle)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, config.WEBHOOK_HOST, config.WEBHOOK_PORT).start()
+        logger.info(f"🌐 Вебхук супервизора слушает {config.WEBHOOK_HOST}:{config.WEBHOOK_PORT}{config.WEBHOOK_PATH}")
+
+        if config.WEBHOOK_URL:
+            await bot.set_webhook(
+                config.WEBHOOK_URL.rstrip("/") + config.WEBHOOK_PATH,
+                secret_token=config.WEBHOOK_SECRET or None,
+                allowed_updates=allowed_updates,
+                drop_pending_updates=True
+            )
+
+        try:
+            await asyncio.Event().wait()
+        finally:
+            await runner.cleanup()
+
+    async def run_polling(self, bot: Bot, allowed_updates: List[str]):
+        await bot.delete_webhook(drop_pending_updates=True)
+        offset = None
+        # Уже пересланные обновления, за которые offset ещё не сдвинут: при повторе их не шлём
+        delivered: set[int] = set()
+        while True:
+            try:
+                updates = await bot.get_updates(offset=offset, timeout=30, allowed_updates=allowed_updates)
+            except Exception:
+                logger.exception("Супервизор: ошибка getUpdates")
+                await asyncio.sleep(RESTART_DELAY)
+                continue
+            if not updates:
+                continue
+
+            fresh = [update for update in updates if update.update_id not in delivered]
+            results = await asyncio.gather(*(
+                self.forward(update.model_dump(mode='json', by_alias=True, exclude_none=True))
+                for update in fresh
+            ))
+            delivered.update(update.update_id for update, ok in zip(fresh, results) if ok)
+
+            failed = [update.update_id for update, ok in zip(fresh, results) if not ok]
+            if not failed:
+                offset = updates[-1].update_id + 1
+                delivered.clear()
+                continue
+
+            # Offset не уходит дальше недоставленного: Telegram вернёт его при следующем запросе
+            offset = min(failed)
+            delivered = {update_id for update_id in delivered if update_id > offset}
+            await asyncio.sleep(RESTART_DELAY)
+
+
+async def run_supervisor(bot: Bot, dp: Dispatcher):
+    """Запускает WORKERS воркеров: каждый владеет каналами channel_id % WORKERS"""
+    # Миграции — до воркеров, чтобы они не применяли их наперегонки
+    await db.init()
+    await db.close()
+
+    supervisor = Supervisor()
+    await supervisor.start()
+    logger.info(f"🚀 Супервизор запущен: {supervisor.workers} воркеров ({config.MODE})")
+
+    allowed_updates = dp.resolve_used_update_types()
+    if config.MODE == "webhook":
+        serve = supervisor.run_webhook(bot, allowed_updates)
+    else:
+        serve = supervisor.run_polling(bot, allowed_updates)
+    try:
+        # SIGTERM (systemd, docker) останавливает так же, как Ctrl+C
+        await until_signal(serve, signal.SIGINT, signal.SIGTERM)
+    finally:
+        await supervisor.stop()
+        await bot.session.close()
@@ -1 +1,3 @@
-﻿from .helpers import format_user
\ No newline at end of file
+﻿from .helpers import format_user, next_schedule_run, shard_of, owns_channel, webhook_secret_ok, SECRET_HEADER
+from .throttling import TokenBucket, RateLimitMiddleware
+from .cache import AsyncCache, approx_size
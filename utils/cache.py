@@ -0,0 +1,145 @@
+import asyncio
+import sys
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional, Tuple
+
+
+def approx_size(value: Any) -> int:
+    """Примерный размер значения в байтах вместе с содержимым контейнеров"""
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(approx_size(k) + approx_size(v) for k, v in value.items())
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        size += sum(approx_size(v) for v in value)
+    return size
+
+
+class AsyncCache:
+    """TTL + LRU кэш с бюджетом по байтам; одновременные промахи по ключу ждут одну загрузку"""
+
+    def __init__(self, ttl: float, max_items: int = 1024, max_bytes: Optional[int] = None,
+                 sizeof: Callable[[Any], int] = approx_size):
+        self.ttl = ttl
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        # Промахи, дождавшиеся чужой загрузки: сами в источник не ходили
+        self.coalesced = 0
+        self.evictions = 0
+        # ключ -> (момент устаревания, размер, значение); порядок — от давно использованных к свежим
+        self._data: OrderedDict[Hashable, Tuple[float, int, Any]] = OrderedDict()
+        self._loading: Dict[Hashable, asyncio.Future] = {}
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        return {
+            'items': len(self._data), 'bytes': self.bytes,
+            'hits': self.hits, 'misses': self.misses, 'coalesced': self.coalesced, 'evictions': self.evictions,
+        }
+
+    def _lookup(self, key: Hashable, default: Any) -> Any:
+        entry = self._data.get(key)
+        if entry is None:
+            return default
+        if entry[0] <= time.monotonic():
+            self._remove(key)
+            return default
+
+        self._data.move_to_end(key)
+        return entry[2]
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        sentinel = object()
+        value = self._lookup(key, sentinel)
+        if value is sentinel:
+            self.misses += 1
+            return default
+        self.hits += 1
+        return value
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None):
+        size = self.sizeof(value)
+        # Значение больше всего бюджета только вытеснило бы остальные
+        if self.max_bytes is not None and size > self.max_bytes:
+            self.pop(key)
+            return
+
+        if key in self._data:
+            self._remove(key)
+        self._data[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), size, value)
+        self.bytes += size
+        self._evict()
+
+    def pop(self, key: Hashable):
+        """Сбрасывает ключ; идущая загрузка не запишет устаревший результат"""
+        self._loading.pop(key, None)
+        if key in self._data:
+            self._remove(key)
+
+    def clear(self):
+        self._data.clear()
+        self._loading.clear()
+        self.bytes = 0
+
+    async def get_or_load(self, key: Hashable, loader: Callable[[], Awaitable[Any]],
+                          ttl: Optional[float] = None) -> Any:
+        sentinel = object()
+        value = self._lookup(key, sentinel)
+        if value is not sentinel:
+            self.hits += 1
+            return value
+
+        pending = self._loading.get(key)
+        if pending is not None:
+            self.coalesced += 1
+            return await asyncio.shield(pending)
+
+        self.misses += 1
+        future = asyncio.get_running_loop().create_future()
+        self._loading[key] = future
+        try:
+            value = await loader()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # Ошибку получат ожидающие; если их нет, asyncio не должен ругаться
+            future.exception()
+            raise
+        else:
+            future.set_result(value)
+            if self._loading.get(key) is future:
+                self.set(key, value, ttl)
+            return value
+        finally:
+            if self._loading.get(key) is future:
+                del self._loading[key]
+
+    def _remove(self, key: Hashable):
+        _, size, _ = self._data.pop(key)
+        self.bytes -= size
+
+    def _over_budget(self) -> bool:
+        return len(self._data) > self.max_items or (self.max_bytes is not None and self.bytes > self.max_bytes)
+
+    def _evict(self):
+        if not self._over_budget():
+            return
+
+        # Сначала устаревшие, затем давно не использованные
+        now = time.monotonic()
+        for key in [k for k, (expires, _, _) in self._data.items() if expires <= now]:
+            self._remove(key)
+            self.evictions += 1
+
+        while self._data and self._over_budget():
+            self._remove(next(iter(self._data)))
+            self.evictions += 1
@@ -1,4 +1,10 @@
-﻿from typing import Optional
+﻿import secrets
+from datetime import datetime, time, timedelta
+from typing import Mapping, Optional
+
+from config import config
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
 
 
 def format_user(user_id: int, username: Optional[str], full_name: Optional[str]) -> str:
@@ -8,4 +14,42 @@ def format_user(user_id: int, username: Optional[str], full_name: Optional[str])
     if username:
         parts.append(f"@{username}")
     parts.append(f"<code>{user_id}</code>")
-    return " | ".join(parts)
\ No newline at end of file
+    return " | ".join(parts)
+
+
+def next_schedule_run(schedule: Optional[dict], after: datetime) -> Optional[datetime]:
+    """Ближайший слот расписания строго после after; None, если расписание выключено"""
+    if not schedule or not schedule.get('enabled') or not schedule.get('days'):
+        return None
+
+    try:
+        hour, minute = map(int, schedule.get('time', '12:00').split(':'))
+    except ValueError:
+        return None
+
+    for offset in range(8):
+        day = after.date() + timedelta(days=offset)
+        if day.weekday() not in schedule['days']:
+            continue
+        run = datetime.combine(day, time(hour, minute))
+        if run > after:
+            return run
+    return None
+
+
+def shard_of(channel_id: int, workers: int = config.WORKERS) -> int:
+    """Номер воркера, которому принадлежит канал"""
+    return channel_id % workers
+
+
+def owns_channel(channel_id: int) -> bool:
+    """Канал обслуживает этот процесс: вне супервизора — любой"""
+    return config.WORKER_INDEX < 0 or shard_of(channel_id) == config.WORKER_INDEX
+
+
+def webhook_secret_ok(headers: Mapping[str, str], secret: str) -> bool:
+    """Заголовок вебхука совпал с секретом; пустой секрет — проверки нет"""
+    if not secret:
+        return True
+    # Сравнение за постоянное время, чтобы секрет нельзя было подобрать по задержке ответа
+    return secrets.compare_digest(headers.get(SECRET_HEADER, "").encode(), secret.encode())
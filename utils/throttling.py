@@ -0,0 +1,130 @@
+import asyncio
+import logging
+import time
+from typing import Dict, Optional
+
+from aiogram import Bot
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import GetUpdates, Response, TelegramMethod
+from aiogram.methods.base import TelegramType
+
+from config import config
+
+logger = logging.getLogger(__name__)
+
+# Лимиты Telegram: ~30 запросов в секунду на бота,
+# 1 сообщение в секунду в личный чат и 20 в минуту в группу или канал
+PRIVATE_CHAT_RATE = 1.0
+GROUP_CHAT_RATE = 20 / 60
+SEND_PREFIXES = ('Send', 'Copy', 'Forward')
+CHAT_BUCKETS_LIMIT = 10_000
+
+
+class TokenBucket:
+    """Ведро токенов: rate запросов в секунду, не больше capacity подряд"""
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity or max(rate, 1.0)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    @property
+    def idle(self) -> bool:
+        self._refill()
+        return self.tokens >= self.capacity and time.monotonic() >= self.blocked_until
+
+    async def acquire(self):
+        # Lock выстраивает ожидающих в очередь (FIFO)
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self.blocked_until:
+                    await asyncio.sleep(self.blocked_until - now)
+                    continue
+                self._refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def block(self, seconds: float):
+        """Пауза после flood control: до её конца токены не выдаются"""
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+        self.tokens = 0
+
+
+class RateLimitMiddleware(BaseRequestMiddleware):
+    """Общий и поканальные лимиты для всех запросов к Bot API с повтором после 429"""
+
+    def __init__(self, rate: float = config.API_RATE, max_retries: int = config.API_MAX_RETRIES):
+        self.max_rate = rate
+        self.min_rate = 1.0
+        self.max_retries = max_retries
+        self.bucket = TokenBucket(rate)
+        self.chats: Dict[int, TokenBucket] = {}
+
+    def _chat_bucket(self, method: TelegramMethod) -> Optional[TokenBucket]:
+        if not type(method).__name__.startswith(SEND_PREFIXES):
+            return None
+
+        chat_id = getattr(method, 'chat_id', None)
+        if not isinstance(chat_id, int):
+            return None
+
+        bucket = self.chats.get(chat_id)
+        if bucket is None:
+            if len(self.chats) >= CHAT_BUCKETS_LIMIT:
+                self.chats = {k: b for k, b in self.chats.items() if not b.idle}
+            bucket = TokenBucket(PRIVATE_CHAT_RATE) if chat_id > 0 else TokenBucket(GROUP_CHAT_RATE, capacity=3)
+            self.chats[chat_id] = bucket
+        return bucket
+
+    def _slow_down(self, retry_after: float, chat_bucket: Optional[TokenBucket]):
+        if chat_bucket:
+            # Лимит одного чата: ждёт только он, остальные запросы идут в прежнем темпе
+            chat_bucket.block(retry_after)
+            return
+        # Общий flood control: мультипликативно снижаем темп и ждём, сколько попросил Telegram
+        self.bucket.rate = max(self.min_rate, self.bucket.rate / 2)
+        self.bucket.block(retry_after)
+
+    def _speed_up(self):
+        if self.bucket.rate < self.max_rate:
+            self.bucket.rate = min(self.max_rate, self.bucket.rate + 0.1)
+
+    async def __call__(
+            self,
+            make_request: NextRequestMiddlewareType[TelegramType],
+            bot: Bot,
+            method: TelegramMethod[TelegramType],
+    ) -> Response[TelegramType]:
+        if isinstance(method, GetUpdates):
+            return await make_request(bot, method)
+
+        chat_bucket = self._chat_bucket(method)
+
+        for attempt in range(self.max_retries + 1):
+            if chat_bucket:
+                await chat_bucket.acquire()
+            await self.bucket.acquire()
+
+            try:
+                response = await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                if attempt == self.max_retries:
+                    raise
+                logger.warning(f"⏳ Flood control: {type(method).__name__}, ждём {e.retry_after} с")
+                self._slow_down(e.retry_after, chat_bucket)
+                continue
+
+            self._speed_up()
+            return response